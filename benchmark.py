@@ -0,0 +1,328 @@
+"""
+Headless benchmarks for PiPianoUI and the bundled instruments.
+
+Runs PiPianoUI with SDL's dummy video and audio drivers and without the
+Piano-HAT, replays scripted and random key sequences through the
+PiPianoUI handlers, and writes the results as JSON so runs on different
+commits can be compared::
+
+    python benchmark.py --output before.json
+    python benchmark.py --output after.json --compare before.json
+
+For each instrument it reports the construction and switch time, the
+events per second and per event latency of the key handlers, the voice
+allocator, software mixer, MIDI writer and sample reducer counters, the LED bus
+transactions, and the process memory.
+
+It also times drawing the keys and octave meter from the pre-rendered
+sprites against blending them on every event, as PiPianoUI used to.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+import subprocess
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import pygame
+import pipianoui
+from pipianoui import Histogram, _clock
+
+# never touch real hardware while benchmarking, count the LED writes
+pipianoui.pianohat = None
+pipianoui.LEDS = pipianoui.LedFrameBuffer(pipianoui.MockLedBackend())
+# nor write the console messages after the results
+pipianoui.CONSOLE.enabled = False
+
+_SOUNDS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sounds')
+
+class StubSequencer(object):
+    """Stands in for midi.sequencer.SequencerWrite, counting the events"""
+    def __init__(self):
+        self.events = 0
+    def queue_get_tick_time(self):
+        return self.events
+    def subscribe_port(self, client, port):
+        pass
+    def start_sequencer(self):
+        pass
+    def stop_sequencer(self):
+        pass
+    def event_write(self, event, direct=False, relative=False, tick=False):
+        self.events += 1
+
+class StubMidi(pipianoui.Midi):
+    """Midi instrument writing to a StubSequencer"""
+    def open_sequencer(self):
+        return StubSequencer()
+
+def memory():
+    """Resident memory of this process in bytes, where available"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def scripted(count):
+    """Scales up and down, with chords and octave changes"""
+    events = []
+    while len(events) < count:
+        for channel in range(13):
+            events += [('note', channel, True), ('note', channel, False)]
+        for chord in ([0, 4, 7], [5, 9, 12], [7, 11, 2]):
+            events += [('note', c, True) for c in chord]
+            events += [('note', c, False) for c in chord]
+        events += [('octave_up', 14, True), ('octave_up', 14, False)]
+        for channel in reversed(range(13)):
+            events += [('note', channel, True), ('note', channel, False)]
+        events += [('octave_down', 13, True), ('octave_down', 13, False)]
+    return events[:count]
+
+def randomized(count, seed):
+    """Random presses and releases, holding up to 4 keys at once"""
+    rand = random.Random(seed)
+    events = []
+    held = []
+    while len(events) < count:
+        r = rand.random()
+        if r < 0.05:
+            events.append((rand.choice(['octave_up', 'octave_down']), 14, True))
+        elif held and (len(held) >= 4 or r < 0.5):
+            events.append(('note', held.pop(rand.randrange(len(held))), False))
+        else:
+            channel = rand.randrange(13)
+            if channel not in held:
+                held.append(channel)
+                events.append(('note', channel, True))
+    events += [('note', channel, False) for channel in held]
+    return events
+
+def pump(ui):
+    """Handle the frame and message events the way main() does"""
+    for event in pygame.event.get():
+        if event.type == pipianoui._FRAME_EVENT:
+            ui.frame()
+        elif event.type == pipianoui._MESSAGE_EVENT:
+            ui.message(event.message)
+
+def wait_ready(instrument, timeout=60):
+    """Wait for a WavPlayer to finish loading its samples"""
+    loader = getattr(instrument, 'loader', None)
+    end = time.time() + timeout
+    while loader and not loader.done() and time.time() < end:
+        time.sleep(0.001)
+
+def replay(ui, events):
+    """Send the events through the PiPianoUI handlers, timing each call"""
+    handlers = dict(note=ui.handle_note, octave_up=ui.handle_octave_up,
+                    octave_down=ui.handle_octave_down)
+    latency = Histogram()
+    render = Histogram()
+    start = _clock()
+    for i, (kind, channel, pressed) in enumerate(events):
+        t = _clock()
+        handlers[kind](channel, pressed)
+        latency.add(_clock() - t)
+        if i % 8 == 0:
+            t = _clock()
+            pump(ui)
+            render.add(_clock() - t)
+    elapsed = _clock() - start
+    return dict(events=len(events), seconds=elapsed,
+                events_per_second=len(events) / elapsed if elapsed else 0.0,
+                latency=latency.summary(), render=render.summary())
+
+def factories():
+    """(name, factory) for each bundled instrument type"""
+    result = [('Instrument', pipianoui.Instrument),
+              ('Synth8Bit', pipianoui.Synth8Bit),
+              ('Synth8Bit:software', lambda: pipianoui.Synth8Bit(software=True))]
+    for folder in sorted(os.listdir(_SOUNDS)):
+        path = os.path.join(_SOUNDS, folder)
+        if not os.path.isdir(path):
+            continue
+        result.append(('WavPlayer:' + folder, lambda path=path: pipianoui.WavPlayer(path)))
+        result.append(('WavPlayer:pitch:' + folder,
+                       lambda path=path: pipianoui.WavPlayer(path, pitch_shift=True)))
+        result.append(('WavPlayer:reduced:' + folder,
+                       lambda path=path: pipianoui.WavPlayer(path, reducer=pipianoui.SampleReducer())))
+        # the bundled folders have no mp3s, so stream their wavs as songs
+        result.append(('Songs:' + folder,
+                       lambda path=path: pipianoui.Songs(path, filetypes=('*.wav',))))
+    if pipianoui.midi:
+        result.append(('Midi', lambda: StubMidi(128, 'stub')))
+    else:
+        print("python-midi not installed, skipping Midi")
+    return result
+
+def bench_instrument(ui, name, factory, events, seed):
+    leds = pipianoui.LEDS
+    leds.backend.transactions = 0
+    requests = leds.requests
+    before = memory()
+    t = _clock()
+    instrument = factory()
+    construct = _clock() - t
+    if isinstance(instrument, pipianoui.WavPlayer) and not instrument.files:
+        return None
+    ui.instruments = [ui.instruments[0], instrument]
+    t = _clock()
+    ui.handle_instrument(15, True)
+    select = _clock() - t
+    wait_ready(instrument)
+    ready = _clock() - t
+    pump(ui)
+    result = dict(construct=construct, select=select, ready=ready,
+                  scripted=replay(ui, scripted(events)),
+                  randomized=replay(ui, randomized(events, seed)))
+    result['voices'] = pipianoui.ENGINE.voices.stats()
+    time.sleep(leds.interval * 2)
+    result['leds'] = dict(requests=leds.requests - requests,
+                          transactions=leds.backend.transactions)
+    if getattr(instrument, 'mixer', None):
+        result['software'] = instrument.mixer.stats()
+    if getattr(instrument, 'writer', None):
+        result['midi'] = instrument.writer.stats()
+    if getattr(instrument, 'reducer', None):
+        result['reduced'] = instrument.reducer.stats()
+    t = _clock()
+    ui.handle_instrument(15, True)
+    result['deselect'] = _clock() - t
+    result['memory'] = memory() - before
+    return result
+
+def blend_key(ui, key_blits, surface, channel, pressed):
+    """Draw a key by blending it on the screen, the way before sprites"""
+    fill, rect, mask, blend = key_blits[channel]
+    if pressed:
+        surface.fill(fill)
+        ui.renderer.add(ui.screen.blit(surface, rect, mask, blend))
+    else:
+        if not mask:
+            mask = (0, 0, ui.width_white_key, ui.height_keys)
+        full_mask = (rect[0], rect[1], mask[2], mask[3])
+        ui.renderer.add(ui.screen.blit(ui.key_graphic, rect, full_mask))
+
+def blend_octaves(ui):
+    """Draw the octave meter by blending each segment, the way before sprites"""
+    octmask = ui.oct_blits[0]
+    ui.renderer.add(ui.screen.blit(ui.key_graphic, (octmask[0], octmask[1]), octmask))
+    for i in range(1, min(ui.octaves+1, 11)):
+        octmask = ui.oct_blits[i]
+        ui.octbar.fill((0, 155, 124))
+        blend = pygame.BLEND_ADD if i <= ui.octave else pygame.BLEND_SUB
+        ui.screen.blit(ui.octbar, (octmask[0], octmask[1]), None, blend)
+
+def bench_render(ui, count):
+    """Time drawing a key event and an octave change, from sprites and by
+    blending, excluding the display update.
+    """
+    result = dict()
+    key_blits = pipianoui.key_maskings(ui.width_white_key, ui.height_keys)
+    surface = pygame.Surface((ui.width_white_key, ui.height_keys))
+    for name, key, octaves in [('sprites', ui.draw_key, ui.draw_octaves),
+                               ('blend', lambda c, p: blend_key(ui, key_blits, surface, c, p),
+                                lambda: blend_octaves(ui))]:
+        keys = Histogram()
+        meter = Histogram()
+        # untimed, so neither method pays for warming up
+        for i in range(min(count, 1000)):
+            key(i % 13, i % 2 == 0)
+        for i in range(count):
+            t = _clock()
+            key(i % 13, i % 2 == 0)
+            keys.add(_clock() - t)
+            ui.octave = i % (ui.octaves + 1)
+            t = _clock()
+            octaves()
+            meter.add(_clock() - t)
+        ui.renderer.frame()
+        result[name] = dict(key=keys.summary(), octave=meter.summary())
+    return result
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(old, new):
+    """Print the change in the headline numbers between two result files"""
+    for name in sorted(new['instruments']):
+        if name not in old['instruments']:
+            continue
+        a = old['instruments'][name]
+        b = new['instruments'][name]
+        for key, get in [('select', lambda r: r['select']),
+                         ('ready', lambda r: r['ready']),
+                         ('events/s', lambda r: r['randomized']['events_per_second']),
+                         ('p99', lambda r: r['randomized']['latency']['p99'])]:
+            before, after = get(a), get(b)
+            change = ((after - before) / before * 100) if before else 0.0
+            print('{:24} {:9} {:12.6f} -> {:12.6f} {:+7.1f}%'.format(name, key, before, after, change))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Headless PiPianoUI benchmarks")
+    parser.add_argument('--events', type=int, default=2000,
+                        help="key events per sequence")
+    parser.add_argument('--seed', type=int, default=1,
+                        help="seed for the random key sequence")
+    parser.add_argument('--only', metavar='NAME', action='append',
+                        help="only run instruments starting with NAME")
+    parser.add_argument('--output', default='benchmark.json',
+                        help="file to write the JSON results to")
+    parser.add_argument('--render-events', type=int, default=2000,
+                        help="draws to time in the render microbenchmark")
+    parser.add_argument('--compare', metavar='FILE',
+                        help="earlier results to compare against")
+    args = parser.parse_args(argv)
+
+    start = _clock()
+    ui = pipianoui.PiPianoUI()
+    results = dict(commit=git_commit(), python=platform.python_version(),
+                   pygame=pygame.version.ver, events=args.events, seed=args.seed,
+                   startup=_clock() - start, instruments=dict())
+    results['render'] = render = bench_render(ui, args.render_events)
+    for name in ('sprites', 'blend'):
+        print('{:24} key p50 {:7.4f}ms p99 {:7.4f}ms octave p50 {:7.4f}ms p99 {:7.4f}ms'.format(
+            'render:' + name, render[name]['key']['p50'] * 1000, render[name]['key']['p99'] * 1000,
+            render[name]['octave']['p50'] * 1000, render[name]['octave']['p99'] * 1000))
+    # the console output would dominate the timings
+    stdout = sys.stdout
+    for name, factory in factories():
+        if args.only and not any(name.startswith(o) for o in args.only):
+            continue
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            result = bench_instrument(ui, name, factory, args.events, args.seed)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        if result is None:
+            continue
+        results['instruments'][name] = result
+        print('{:24} switch {:8.3f}ms ready {:8.3f}ms {:9.0f} events/s p99 {:7.3f}ms'.format(
+            name, result['select'] * 1000, result['ready'] * 1000,
+            result['randomized']['events_per_second'],
+            result['randomized']['latency']['p99'] * 1000))
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print('Wrote ' + args.output)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+    ui.renderer.stop()
+    pipianoui.ENGINE.quit()
+    pygame.quit()
+
+if __name__ == "__main__":
+    main()
@@ -13,11 +13,41 @@ This is only an example, and can be built upon at the client level.
 
 import os
 import re
+import sys
+import math
 import time
 import glob
+import fnmatch
+import heapq
+import json
+import mmap
+import wave
+import struct
+import argparse
 
 import signal
+import tempfile
 import threading
+import collections
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+try:
+    from os import scandir as _scandir
+except ImportError:
+    try:
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
+
+try:
+    _buffer = buffer
+except NameError:
+    def _buffer(obj, offset, size):
+        return memoryview(obj)[offset:offset+size]
 
 try:
     import numpy
@@ -46,6 +76,42 @@ except ImportError:
 _STARTUP_DELAY = 0.05
 _OCTAVE_WIDTH = 43
 _OCTAVE_PADDING = 3
+_MESSAGE_EVENT = pygame.locals.USEREVENT + 1
+_FRAME_EVENT = pygame.locals.USEREVENT + 2
+_MIDI_EVENT = pygame.locals.USEREVENT + 3
+_INPUT_EVENT = pygame.locals.USEREVENT + 4
+_MAX_FPS = 30
+
+def _monotonic_clock():
+    """The clock for latency measurements and scheduling.
+    
+    This has to be monotonic, as a Pi without a real time clock has its
+    wall clock set by NTP after boot, which would move every scheduled
+    event. Python 2 has no ``time.perf_counter``, so on Linux
+    CLOCK_MONOTONIC is read through ctypes instead.
+    """
+    if hasattr(time, 'perf_counter'):
+        return time.perf_counter
+    if not sys.platform.startswith('linux'):
+        return time.time
+    import ctypes
+    import ctypes.util
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+    CLOCK_MONOTONIC = 1
+    try:
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'))
+        clock_gettime = librt.clock_gettime
+    except (OSError, AttributeError):
+        return time.time
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    def monotonic():
+        t = timespec()
+        clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t))
+        return t.tv_sec + t.tv_nsec * 1e-9
+    return monotonic
+
+_clock = _monotonic_clock()
 
 class FlipFlopState():
     def __init__(self, prev_state=False):
@@ -58,26 +124,192 @@ class FlipFlopState():
     def __getitem__(self, i):
         return self.state.get(i, self.prev_state)
 
-def startup_lights(callback=None):
-    """Cycle the leds on the PianoHAT in a pretty way to show things started up.
+class MockLedBackend(object):
+    """Stands in for pianohat as an LedFrameBuffer backend, keeping the LED
+    states and counting the bus transactions instead.
     """
-    if not pianohat:
-        return
-    pianohat.auto_leds(False)
-    led = FlipFlopState()
+    def __init__(self, count=16):
+        self.leds = [False] * count
+        self.auto = True
+        self.transactions = 0
+    
+    def set_led(self, index, state):
+        self.leds[index] = bool(state)
+        self.transactions += 1
+    
+    def auto_leds(self, enable=True):
+        self.auto = bool(enable)
+        self.transactions += 1
+
+class LedFrameBuffer(object):
+    """The wanted state of the Piano-HAT's 16 LEDs, written to the
+    ``backend`` (pianohat, or a MockLedBackend) by a background thread.
+    
+    Each LED write is an I2C transaction, so setting LEDs only changes the
+    buffer, and once a tick, ``interval`` seconds after the first change,
+    the thread writes the LEDs that differ from what is shown. ``animate``
+    queues frames for the thread to show in turn. Without a backend
+    nothing is written.
+    """
+    COUNT = 16
+    
+    def __init__(self, backend, interval=0.01):
+        self.backend = backend
+        self.interval = interval
+        self.wanted = [False] * self.COUNT
+        self.shown = [None] * self.COUNT
+        self.auto = True
+        self.shown_auto = None
+        self.frames = collections.deque()
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = None
+        self.requests = 0
+        self.writes = 0
+        self.flushes = 0
+    
+    def set(self, index, state):
+        with self.lock:
+            self.wanted[index] = bool(state)
+            self.requests += 1
+        self.changed()
+    
+    def set_all(self, states):
+        with self.lock:
+            self.wanted[:] = [bool(state) for state in states]
+            self.requests += self.COUNT
+        self.changed()
+    
+    def clear(self):
+        self.set_all([False] * self.COUNT)
+    
+    def auto_leds(self, enable=True):
+        """Let the Piano-HAT light the keys as they are touched"""
+        with self.lock:
+            self.auto = bool(enable)
+            self.requests += 1
+        self.changed()
+    
+    def animate(self, frames, delay, auto=None):
+        """Show each of ``frames``, states of all the LEDs, ``delay``
+        seconds apart, then set ``auto_leds`` if not None.
+        """
+        start = _clock()
+        with self.lock:
+            self.frames.extend((start + i * delay, list(frame), None)
+                               for i, frame in enumerate(frames))
+            if auto is not None and self.frames:
+                when, frame, _ = self.frames.pop()
+                self.frames.append((when, frame, auto))
+        self.changed()
+    
+    def animating(self):
+        return bool(self.frames)
+    
+    def changed(self):
+        if not self.backend:
+            return
+        if not self.thread:
+            with self.lock:
+                if not self.thread:
+                    self.thread = threading.Thread(target=self.run, name='LedFrameBuffer')
+                    self.thread.daemon = True
+                    self.thread.start()
+        self.wake.set()
+    
+    def flush(self):
+        """Write the LEDs that changed, returns the number of writes"""
+        with self.lock:
+            now = _clock()
+            while self.frames and self.frames[0][0] <= now:
+                when, frame, auto = self.frames.popleft()
+                self.wanted[:] = frame
+                if auto is not None:
+                    self.auto = auto
+            wanted = list(self.wanted)
+            auto = self.auto
+        writes = 0
+        if auto != self.shown_auto:
+            if self.shown_auto:
+                # the Piano-HAT may have changed the LEDs meanwhile
+                self.shown = [None] * self.COUNT
+            self.backend.auto_leds(auto)
+            self.shown_auto = auto
+            writes += 1
+        for index, state in enumerate(wanted):
+            if state != self.shown[index]:
+                self.backend.set_led(index, state)
+                self.shown[index] = state
+                writes += 1
+        self.writes += writes
+        self.flushes += 1
+        return writes
+    
+    def run(self):
+        while True:
+            with self.lock:
+                timeout = self.frames[0][0] - _clock() if self.frames else None
+            if timeout is None or timeout > 0:
+                self.wake.wait(timeout)
+            self.wake.clear()
+            # gather the changes made together into one flush
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except (IOError, OSError) as e:
+                print("Error: couldn't set LEDs: {}".format(e))
+    
+    def stats(self):
+        return dict(requests=self.requests, writes=self.writes, flushes=self.flushes)
+
+LEDS = LedFrameBuffer(pianohat)
+
+def startup_frames():
+    """LED frames of the startup lights, keys lighting up in turn with
+    the octave and instrument LEDs flickering.
+    """
+    leds = [False] * 16
+    frames = []
     for i in xrange(16):
         if i < 13:
-            pianohat.set_led(i, True)
+            leds[i] = True
         if i-3 >= 0:
-            pianohat.set_led(i-3, False)
+            leds[i-3] = False
         j = 13+(i%3)
-        pianohat.set_led(j,led.toggle(j))
+        leds[j] = not leds[j]
+        frames.append(list(leds))
+    frames.append([False] * 16)
+    return frames
+
+def startup_lights(callback=None):
+    """Cycle the leds on the PianoHAT in a pretty way to show things started up.
+    
+    With a ``callback`` it is called after each frame and this returns when
+    the lights are done, otherwise the lights are animated in the background.
+    """
+    if not pianohat:
+        return
+    LEDS.auto_leds(False)
+    if not callback:
+        LEDS.animate(startup_frames(), _STARTUP_DELAY, auto=True)
+        return
+    for frame in startup_frames():
+        LEDS.set_all(frame)
         time.sleep(_STARTUP_DELAY)
-        if callback and callable(callback):
+        if callable(callback):
             callback()
-    for i in xrange(16):
-        pianohat.set_led(1, False)
-    pianohat.auto_leds(True)
+    LEDS.auto_leds(True)
+
+def post_message(message):
+    """Send a message to the PiPianoUI console from any thread.
+    
+    The message is delivered through the pygame event queue and shown by
+    the main loop, so background work never draws to the screen itself.
+    """
+    try:
+        pygame.event.post(pygame.event.Event(_MESSAGE_EVENT, message=message))
+    except pygame.error:
+        print(message)
 
 def load_img(name):
     """Load image and return an image object"""
@@ -134,7 +366,678 @@ def octave_maskings(width, height, hp=2, wp=3):
         result[-f][1] += 1
     result[-1][1] += 1
     return pygame.Surface((oct_width, oct_height)), result
+
+def opaque_sprite(key_graphic, area):
+    """``area`` of the key graphic drawn over the black screen it is shown
+    on, without an alpha channel, so blitting it is a plain copy.
+    """
+    sprite = pygame.Surface(area.size).convert()
+    sprite.blit(key_graphic, (0, 0), area)
+    return sprite
+
+def key_sprites(key_graphic, key_blits, width_white_key, height):
+    """Render each key pressed and released once, as (rect, pressed,
+    released) so drawing a key is a plain blit.
+    """
+    result = []
+    for fill, (x, y), mask, blend in key_blits:
+        if not mask:
+            mask = (0, 0, width_white_key, height)
+        rect = pygame.Rect(x, y, mask[2], mask[3])
+        released = opaque_sprite(key_graphic, rect)
+        pressed = released.copy()
+        highlight = pygame.Surface(rect.size)
+        highlight.fill(fill)
+        pressed.blit(highlight, (0, 0), None, blend)
+        result.append((rect, pressed, released))
+    return result
+
+def octave_sprite(key_graphic, octbar, oct_blits, octaves, octave):
+    """Render the octave meter showing ``octave`` of ``octaves``"""
+    area = pygame.Rect(oct_blits[0])
+    sprite = opaque_sprite(key_graphic, area)
+    octbar.fill((0, 155, 124))
+    for i in xrange(1, min(octaves+1, 11)):
+        octmask = oct_blits[i]
+        blend = pygame.BLEND_ADD if i <= octave else pygame.BLEND_SUB
+        sprite.blit(octbar, (octmask[0] - area.x, octmask[1] - area.y), None, blend)
+    return sprite
+
+def octave_sprites(key_graphic, octbar, oct_blits, max_octaves=10):
+    """Render every state of the octave meter, keyed by (octaves, octave)"""
+    result = dict()
+    for octaves in xrange(max_octaves+1):
+        for octave in xrange(octaves+1):
+            result[octaves, octave] = octave_sprite(key_graphic, octbar, oct_blits,
+                                                     octaves, octave)
+    return result
+    
+class Histogram(object):
+    """Latency histogram with logarithmic buckets, from 10us to 100s.
+    
+    Adding a value is a log and a list increment, percentiles are the upper
+    edge of the bucket they fall in.
+    """
+    MIN = 1e-5
+    PER_DECADE = 20
+    
+    def __init__(self):
+        self.counts = [0] * (7 * self.PER_DECADE + 2)
+        self.count = 0
+        self.max = 0.0
+    
+    def add(self, seconds):
+        if seconds > self.MIN:
+            i = min(int(math.log10(seconds / self.MIN) * self.PER_DECADE) + 1,
+                    len(self.counts) - 1)
+        else:
+            i = 0
+        self.counts[i] += 1
+        self.count += 1
+        if seconds > self.max:
+            self.max = seconds
+    
+    def percentile(self, p):
+        target = self.count * p / 100.0
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= target:
+                return min(self.MIN * 10 ** (float(i) / self.PER_DECADE), self.max)
+        return 0.0
+    
+    def summary(self):
+        return dict(count=self.count, p50=self.percentile(50), p95=self.percentile(95),
+                    p99=self.percentile(99), max=self.max)
+
+class LatencyProbe(object):
+    """Optional timestamps along the path from key press to sound.
+    
+    A key event starts a measurement with ``start``, and each stage it
+    passes through calls ``mark`` with the stage name. The time since the
+    key event is added to a Histogram per instrument and stage::
+    
+        handle_note  PiPianoUI.handle_note entered
+        note_on      Instrument.note_on called
+        play         the mixer play, or midi event_write, called
+        sounded      Instrument.note_on returned, the note is playing
+        render       the key has been drawn on the display
+    
+    Measurements are per thread, so the pianohat and pygame inputs do not
+    mix. Callers check ``enabled`` before marking, so when it is off the
+    cost is one attribute lookup.
+    """
+    STAGES = ('handle_note', 'note_on', 'play', 'sounded', 'render')
+    
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.histograms = collections.defaultdict(Histogram)
+        self.local = threading.local()
+    
+    def start(self, name, timestamp):
+        self.local.name = name
+        self.local.timestamp = timestamp
+    
+    def mark(self, stage):
+        timestamp = getattr(self.local, 'timestamp', None)
+        if timestamp is not None:
+            self.record(self.local.name, stage, _clock() - timestamp)
+    
+    def record(self, name, stage, seconds):
+        self.histograms[(name, stage)].add(seconds)
+    
+    def summary(self):
+        return dict((name + ' ' + stage, h.summary())
+                    for (name, stage), h in self.histograms.items())
+    
+    def report(self, name=None):
+        """Lines of p50/p95/p99/max in ms for each instrument and stage"""
+        lines = []
+        for (inst, stage), h in sorted(self.histograms.items(),
+                                       key=lambda i: (i[0][0], self.STAGES.index(i[0][1]))):
+            if name is not None and inst != name:
+                continue
+            lines.append('{} {} n={count} p50={p50:.2f} p95={p95:.2f} p99={p99:.2f} max={max:.2f}ms'.format(
+                inst, stage, count=h.count, **dict((k, v * 1000) for k, v in h.summary().items()
+                                                   if k != 'count')))
+        return lines
+    
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2, sort_keys=True)
+
+PROBE = LatencyProbe()
+
+class StartupProfiler(object):
+    """Times each phase of starting up, to keep the time to the first note
+    down.
+    
+    ``mark`` ends a phase on the main thread, timed from the previous mark.
+    ``background`` runs work on a thread in parallel, timed on its own.
+    """
+    def __init__(self):
+        self.started = _clock()
+        self.last = self.started
+        self.phases = []
+        self.lock = threading.Lock()
+    
+    def add(self, name, seconds):
+        with self.lock:
+            self.phases.append((name, seconds))
+    
+    def mark(self, name):
+        now = _clock()
+        self.add(name, now - self.last)
+        self.last = now
+    
+    def background(self, name, work, *args):
+        """Start ``work(*args)`` on a thread, returns a StartupTask"""
+        return StartupTask(self, name, work, args)
+    
+    def total(self):
+        return self.last - self.started
+    
+    def report(self):
+        return 'startup {:.0f}ms: {}'.format(self.total() * 1000, ', '.join(
+            '{} {:.0f}ms'.format(name, seconds * 1000) for name, seconds in self.phases))
+
+class StartupTask(object):
+    """Work started by StartupProfiler.background"""
+    def __init__(self, profiler, name, work, args):
+        self.profiler = profiler
+        self.name = name
+        self.work = work
+        self.args = args
+        self.value = None
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name='Startup:' + name)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def run(self):
+        start = _clock()
+        try:
+            self.value = self.work(*self.args)
+        except Exception as e:
+            self.error = e
+        self.profiler.add(self.name + '*', _clock() - start)
+    
+    def result(self):
+        """Wait for the work to finish and return what it returned"""
+        self.thread.join()
+        if self.error:
+            raise self.error
+        return self.value
+
+class DirtyRenderer(object):
+    """Collect the changed areas of the screen and update them together,
+    at most ``max_fps`` times a second.
+    
+    Drawing code calls ``add`` with the rectangle it changed, or ``defer``
+    to do the drawing itself at the next frame. The first change of a frame
+    starts a pygame timer which posts a _FRAME_EVENT when the next frame is
+    due; the main loop calls ``frame`` on that event to run the deferred
+    drawing and update every dirty rectangle with a single display update.
+    However fast keys are played there is at most one update per frame.
+    """
+    def __init__(self, max_fps=_MAX_FPS):
+        self.max_fps = max_fps
+        self.rects = []
+        self.deferred = []
+        self.last = 0
+        self.scheduled = False
+        self.frames = 0
+        self.lock = threading.Lock()
+    
+    def schedule(self):
+        """Start the frame timer if it is not already running, call with
+        the lock held. Returns the timer delay in ms, or None.
+        """
+        if self.scheduled:
+            return None
+        self.scheduled = True
+        wait = self.last + (1.0 / self.max_fps) - time.time()
+        return max(1, int(wait * 1000) + 1)
+    
+    def add(self, rect):
+        """Mark ``rect`` as changed, and make sure a frame is scheduled"""
+        with self.lock:
+            self.rects.append(pygame.Rect(rect))
+            delay = self.schedule()
+        if delay:
+            pygame.time.set_timer(_FRAME_EVENT, delay)
+    
+    def defer(self, draw, *args):
+        """Call ``draw(*args)`` from the main loop at the next frame"""
+        with self.lock:
+            self.deferred.append((draw, args))
+            delay = self.schedule()
+        if delay:
+            pygame.time.set_timer(_FRAME_EVENT, delay)
+    
+    def frame(self):
+        """_FRAME_EVENT handler, run the deferred drawing and update the
+        display with the dirty rectangles.
+        """
+        pygame.time.set_timer(_FRAME_EVENT, 0)
+        with self.lock:
+            deferred = self.deferred
+            self.deferred = []
+        for draw, args in deferred:
+            draw(*args)
+        with self.lock:
+            rects = self.rects
+            self.rects = []
+            self.scheduled = False
+            self.last = time.time()
+        if rects:
+            pygame.display.update(rects)
+            self.frames += 1
+        return len(rects)
+    
+    def stop(self):
+        """Cancel the frame timer, pygame can hang quitting with it running"""
+        pygame.time.set_timer(_FRAME_EVENT, 0)
+        with self.lock:
+            self.scheduled = False
+
+class Recorder(object):
+    """Records the notes played, from any instrument, to a Standard MIDI File.
+    
+    Each note is stored as (time, channel, octave, on, instrument) in a
+    preallocated numpy ring buffer, so recording allocates nothing on the
+    note path. A background thread spools the buffer to a temporary file
+    whenever it is half full, keeping memory constant however long the
+    session, and ``stop`` writes the .mid file from the spool with
+    python-midi on that thread. Each instrument gets its own track and
+    MIDI channel. Notes are recorded from the main thread and the
+    Scheduler thread, which take turns with ``writing``.
+    """
+    DTYPE = numpy.dtype([('time', 'f8'), ('channel', 'u1'), ('octave', 'u1'),
+                         ('on', '?'), ('instrument', 'u2')])
+    RESOLUTION = 480
+    BPM = 120
+    
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self.events = numpy.zeros(capacity, self.DTYPE)
+        self.instruments = []
+        self.instrument_ids = dict()
+        self.recording = False
+        self.count = 0
+        self.spooled = 0
+        self.overruns = 0
+        self.started = 0.0
+        self.path = None
+        self.spool = None
+        self.lock = threading.Lock()
+        self.writing = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = None
+    
+    def start(self):
+        """Start a new recording, False if python-midi isn't available"""
+        if not midi or self.recording or (self.thread and self.thread.is_alive()):
+            return False
+        self.spool = tempfile.TemporaryFile()
+        self.instruments = []
+        self.instrument_ids = dict()
+        self.count = self.spooled = self.overruns = 0
+        self.started = _clock()
+        self.recording = True
+        self.thread = threading.Thread(target=self.run, name='Recorder')
+        self.thread.daemon = True
+        self.thread.start()
+        return True
+    
+    def record(self, channel, octave, on, instrument, timestamp=None):
+        with self.writing:
+            ident = self.instrument_ids.get(instrument)
+            if ident is None:
+                ident = self.instrument_ids[instrument] = len(self.instruments)
+                self.instruments.append(instrument)
+            event = self.events[self.count % self.capacity]
+            event['time'] = (timestamp or _clock()) - self.started
+            event['channel'] = channel
+            event['octave'] = octave
+            event['on'] = on
+            event['instrument'] = ident
+            self.count += 1
+        if self.count - self.spooled >= self.capacity // 2:
+            self.wake.set()
+    
+    def stop(self, path):
+        """Stop recording and write the .mid file to ``path`` in the
+        background, posting a message when it is saved.
+        """
+        if not self.recording:
+            return
+        self.recording = False
+        self.path = path
+        self.wake.set()
+    
+    def drain(self):
+        """Append the events not yet spooled to the spool file"""
+        with self.lock:
+            count = self.count
+            if count - self.spooled > self.capacity:
+                # the thread fell a whole buffer behind, those are lost
+                self.overruns += count - self.spooled - self.capacity
+                self.spooled = count - self.capacity
+            start, end = self.spooled % self.capacity, count % self.capacity
+            if count - self.spooled == self.capacity or (end < start):
+                self.events[start:].tofile(self.spool)
+                start = 0
+            self.events[start:end].tofile(self.spool)
+            self.spooled = count
+    
+    def run(self):
+        while self.recording:
+            self.wake.wait()
+            self.wake.clear()
+            self.drain()
+        self.drain()
+        try:
+            self.save(self.path)
+        except (IOError, OSError) as e:
+            print("Error: couldn't save recording: {} {}".format(self.path, e))
+        finally:
+            self.spool.close()
+            self.spool = None
+    
+    def save(self, path):
+        self.spool.seek(0)
+        events = numpy.fromfile(self.spool, self.DTYPE)
+        # ticks per second at the pattern's tempo
+        scale = self.RESOLUTION * self.BPM / 60.0
+        pattern = midi.Pattern(resolution=self.RESOLUTION)
+        for ident, name in enumerate(self.instruments):
+            track = midi.Track()
+            track.append(midi.TrackNameEvent(tick=0, text=name or 'PiPianoUI', data=[]))
+            track.append(midi.SetTempoEvent(tick=0, bpm=self.BPM))
+            tick = 0
+            for event in events[events['instrument'] == ident]:
+                now = int(round(event['time'] * scale))
+                pitch = min(int(event['octave']) * 12 + int(event['channel']), 127)
+                kind = midi.NoteOnEvent if event['on'] else midi.NoteOffEvent
+                track.append(kind(tick=max(now - tick, 0), channel=ident % 16,
+                                  pitch=pitch, velocity=100 if event['on'] else 0))
+                tick = max(now, tick)
+            track.append(midi.EndOfTrackEvent(tick=1))
+            pattern.append(track)
+        midi.write_midifile(path, pattern)
+        post_message('saved {} notes {}'.format(len(events), os.path.basename(path)))
+    
+    def stats(self):
+        return dict(recording=self.recording, events=self.count,
+                    spooled=self.spooled, overruns=self.overruns)
+
+class Scheduler(object):
+    """Runs callbacks at given ``_clock`` times from a background thread.
+    
+    Times are absolute, so timing errors never accumulate over a long
+    sequence. The thread sleeps until ``lookahead`` seconds before the next
+    callback is due, then spins for the rest, as sleeps alone wake too
+    late on a Pi. How late each callback finishes, for a note when it has
+    started playing, is measured in ``jitter``, and those more than
+    ``late`` seconds late are counted.
+    """
+    def __init__(self, lookahead=0.002, late=0.005):
+        self.lookahead = lookahead
+        self.late = late
+        self.events = []
+        self.sequence = 0
+        self.condition = threading.Condition()
+        self.thread = None
+        self.jitter = Histogram()
+        self.count = 0
+        self.late_count = 0
+    
+    def at(self, when, callback, args=(), owner=None):
+        """Call ``callback(*args)`` at ``when``, ``owner`` lets a group of
+        callbacks be cancelled together.
+        """
+        with self.condition:
+            self.sequence += 1
+            heapq.heappush(self.events, (when, self.sequence, owner, callback, args))
+            if not self.thread:
+                self.thread = threading.Thread(target=self.run, name='Scheduler')
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify()
     
+    def cancel(self, owner):
+        """Drop the callbacks not yet run for ``owner``"""
+        with self.condition:
+            self.events = [e for e in self.events if e[2] is not owner]
+            heapq.heapify(self.events)
+            self.condition.notify()
+    
+    def pending(self, owner):
+        with self.condition:
+            return sum(1 for e in self.events if e[2] is owner)
+    
+    def due(self):
+        """Wait for the next callback due, None when there are none left"""
+        with self.condition:
+            while self.events:
+                wait = self.events[0][0] - _clock() - self.lookahead
+                if wait <= 0:
+                    return heapq.heappop(self.events)
+                self.condition.wait(wait)
+            self.thread = None
+            return None
+    
+    def run(self):
+        while True:
+            event = self.due()
+            if event is None:
+                return
+            when, sequence, owner, callback, args = event
+            while _clock() < when:
+                time.sleep(0)
+            try:
+                callback(*args)
+            except Exception as e:
+                print("Error: scheduled {} failed: {}".format(getattr(callback, '__name__', callback), e))
+            late = _clock() - when
+            self.jitter.add(late)
+            self.count += 1
+            if late > self.late:
+                self.late_count += 1
+    
+    def stats(self):
+        return dict(count=self.count, late=self.late_count, jitter=self.jitter.summary())
+    
+    def __str__(self):
+        jitter = self.jitter.summary()
+        return 'scheduled {} jitter p50 {:.2f}ms p99 {:.2f}ms max {:.2f}ms, {} late'.format(
+            self.count, jitter['p50'] * 1000, jitter['p99'] * 1000, jitter['max'] * 1000,
+            self.late_count)
+
+SCHEDULER = Scheduler()
+
+class InputQueue(object):
+    """Timestamped input events from every source, for one consumer.
+    
+    Any thread can ``post`` an event, (timestamp, kind, channel, pressed,
+    octave), which is appended to a deque and wakes the main loop with a
+    single _INPUT_EVENT until the queue is drained again. The main loop
+    takes everything waiting with ``drain``, so only it ever calls the
+    instruments or draws.
+    """
+    def __init__(self):
+        self.events = collections.deque()
+        self.lock = threading.Lock()
+        self.woken = False
+        self.dispatch = Histogram()
+        self.count = 0
+        self.batches = 0
+        self.coalesced = 0
+    
+    def post(self, kind, channel, pressed, octave=None, timestamp=None):
+        self.events.append((timestamp or _clock(), kind, channel, pressed, octave))
+        with self.lock:
+            if self.woken:
+                return
+            self.woken = True
+        try:
+            pygame.event.post(pygame.event.Event(_INPUT_EVENT))
+        except pygame.error:
+            pass
+    
+    def drain(self):
+        """The events waiting, oldest first"""
+        with self.lock:
+            self.woken = False
+        events = []
+        while self.events:
+            events.append(self.events.popleft())
+        if events:
+            self.count += len(events)
+            self.batches += 1
+        return events
+    
+    def stats(self):
+        return dict(events=self.count, batches=self.batches, coalesced=self.coalesced,
+                    waiting=len(self.events), dispatch=self.dispatch.summary())
+    
+    def __str__(self):
+        dispatch = self.dispatch.summary()
+        return 'input {} events in {} batches, {} coalesced, p99 {:.2f}ms max {:.2f}ms'.format(
+            self.count, self.batches, self.coalesced, dispatch['p99'] * 1000, dispatch['max'] * 1000)
+
+class ConsoleLogger(object):
+    """Writes the console messages to stdout from a background thread.
+    
+    ``write`` only appends to a deque, so a slow serial or SSH console
+    never holds up the key handling. At most ``rate`` lines a second are
+    written, the others are skipped and counted, as are lines dropped when
+    ``maxlen`` are already waiting, and nothing is written when not
+    ``enabled``. ``stop`` ends the thread and writes what is left.
+    """
+    def __init__(self, rate=20, enabled=True, maxlen=1000):
+        self.enabled = enabled
+        self.lines = collections.deque(maxlen=maxlen)
+        self.wake = threading.Event()
+        self.lock = threading.Lock()
+        self.flushing = threading.Lock()
+        self.thread = None
+        self.running = True
+        self.set_rate(rate)
+        self.last = _clock()
+        self.skipped = 0
+        self.unreported = 0
+        self.dropped = 0
+        self.counted = 0
+        self.written = 0
+    
+    def set_rate(self, rate):
+        """Most lines written a second, starting with a full second's worth"""
+        self.rate = rate
+        self.tokens = rate
+    
+    def write(self, line):
+        if not self.enabled:
+            return
+        if len(self.lines) == self.lines.maxlen:
+            self.dropped += 1
+        self.lines.append(line)
+        if not self.thread:
+            with self.lock:
+                if not self.thread:
+                    self.thread = threading.Thread(target=self.run, name='ConsoleLogger')
+                    self.thread.daemon = True
+                    self.thread.start()
+        self.wake.set()
+    
+    def flush(self):
+        """Write the waiting lines, within the rate"""
+        with self.flushing:
+            self.write_lines()
+    
+    def write_lines(self):
+        dropped = self.dropped - self.counted
+        self.counted += dropped
+        self.skipped += dropped
+        self.unreported += dropped
+        while self.lines:
+            line = self.lines.popleft()
+            now = _clock()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens < 1:
+                self.skipped += 1
+                self.unreported += 1
+                continue
+            self.tokens -= 1
+            if self.unreported:
+                sys.stdout.write('... {} messages skipped\n'.format(self.unreported))
+                self.unreported = 0
+            sys.stdout.write(line + '\n')
+            self.written += 1
+        sys.stdout.flush()
+    
+    def run(self):
+        while self.running:
+            self.wake.wait()
+            self.wake.clear()
+            try:
+                self.flush()
+            except (IOError, OSError, ValueError):
+                pass
+    
+    def stop(self):
+        """Stop the thread, then write the lines still waiting"""
+        self.running = False
+        self.wake.set()
+        with self.lock:
+            thread = self.thread
+        if thread:
+            thread.join()
+        with self.flushing:
+            self.write_lines()
+            if self.unreported:
+                sys.stdout.write('... {} messages skipped\n'.format(self.unreported))
+                sys.stdout.flush()
+                self.unreported = 0
+    
+    def stats(self):
+        return dict(written=self.written, skipped=self.skipped, waiting=len(self.lines))
+
+CONSOLE = ConsoleLogger()
+
+class TextCache(object):
+    """LRU cache of the console surface rendered for each message.
+    
+    The same note messages come round again and again, so most messages
+    are a single blit of a surface rendered earlier.
+    """
+    def __init__(self, font, size, capacity=64):
+        self.font = font
+        self.size = size
+        self.capacity = capacity
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, text):
+        surface = self.entries.pop(text, None)
+        if surface is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            surface = pygame.Surface(self.size)
+            surface.fill((255, 255, 255))
+            surface.blit(self.font.render(text, 2, (0, 0, 0)), (0, 0))
+            if len(self.entries) >= self.capacity:
+                self.entries.popitem(last=False)
+        self.entries[text] = surface
+        return surface
+    
+    def stats(self):
+        return dict(entries=len(self.entries), hits=self.hits, misses=self.misses)
+
 class PiPianoUI():
     """Graphical interface for the PianoHat and multiple instruments.
     
@@ -144,11 +1047,39 @@ class PiPianoUI():
     
     
     The Instrument class can be inherited from to easily implement Add multiple instruments.
+    
+    Drawing is collected by a DirtyRenderer, which updates the display at
+    most ``max_fps`` times a second from the main loop.
+    
+    With ``audio_first`` the instrument is called as soon as a key event
+    arrives and drawing the key and message is left to the renderer,
+    otherwise the pressed key is drawn and the display updated first. When
+    the LatencyProbe PROBE is enabled each stage from the key event to the
+    note playing and the display is measured in either mode.
+    
+    Inputs from other threads, like the pianohat callbacks, are posted to
+    the InputQueue ``inputs`` and handled by ``handle_inputs`` on the main
+    thread.
+    
+    Messages are drawn from the TextCache ``text`` and logged to stdout by
+    the ConsoleLogger CONSOLE.
+    
+    Each phase of starting up is timed by the StartupProfiler ``startup``.
+    With ``fast_start`` the startup lights play in the background.
     """
-    def __init__(self):
+    def __init__(self, max_fps=_MAX_FPS, audio_first=True, startup=None, fast_start=False):
+        self.startup = startup = startup or StartupProfiler()
+        self.fast_start = fast_start
+        ENGINE.pre_init()
         pygame.init()
         pygame.font.init()
-        font = pygame.font.SysFont('monospace', 14)
+        startup.mark('pygame')
+        if fast_start:
+            # finding and loading the font is slow, load it while drawing
+            font = startup.background('font', pygame.font.SysFont, 'monospace', 14)
+        else:
+            font = pygame.font.SysFont('monospace', 14)
+            startup.mark('font')
         screen = pygame.display.set_mode((300, 150))
         fdir = os.path.dirname(os.path.abspath(__file__))
         (key_graphic, kgrect) = load_img(os.path.join(fdir,'hat_keys.png'))
@@ -158,16 +1089,11 @@ class PiPianoUI():
         screen = pygame.display.set_mode((width, height + 20))
         pygame.display.set_caption("PiPianoUi")
         
-        pressed = pygame.Surface((width_white_key, height))
-        pressed.fill((0, 230, 0))
-        
         console = pygame.Surface((width, 20))
         console.fill((255, 255, 255))
         
         screen.blit(key_graphic, (0, 0))
-        pygame.display.update()
         screen.blit(console, (0, height))
-        pygame.display.update()
 
         self.width = width
         self.width_keys = width - _OCTAVE_WIDTH
@@ -179,88 +1105,244 @@ class PiPianoUI():
         
         self.screen = screen
         self.key_graphic = key_graphic
+        if fast_start:
+            font = font.result()
         self.font = font
         self.console = console
-        self.pressed = pressed
-        self.key_blits = key_maskings(width_white_key, height)
+        self.text = TextCache(font, console.get_size())
         self.octbar, self.oct_blits = octave_maskings(width, height)
+        # every key and octave meter image is drawn once, here
+        self.key_sprites = key_sprites(key_graphic, key_maskings(width_white_key, height),
+                                       width_white_key, height)
+        # the black keys whose edges each white key's image covers, and the
+        # white key images with those drawn pressed, made on first use
+        self.key_overlaps = [[other for other, (other_rect, _, _) in enumerate(self.key_sprites)
+                              if other_rect.width < rect.width and other_rect.colliderect(rect)]
+                             for rect, _, _ in self.key_sprites]
+        self.held_sprites = dict()
+        self.octave_sprites = octave_sprites(key_graphic, self.octbar, self.oct_blits)
+        self.down = set()
+        self.renderer = DirtyRenderer(max_fps)
+        self.audio_first = audio_first
+        self.rendering = []
+        self.recorder = Recorder()
+        self.looper = None
+        # held around every call into the instrument, the Scheduler thread
+        # plays notes too
+        self.playing = threading.Lock()
+        self.inputs = InputQueue()
         pygame.display.update()
+        startup.mark('display')
         self.instruments = []
         self.instrument_index = 0
         self.instrument = None
+        ENGINE.start()
+        startup.mark('audio')
         self.add_instrument(Instrument())
         self.set_instrument(0)
         self.register()
+        startup.mark('pianohat')
 
     def register(self):
         """Register the callback methods with pianohat
         """
         if not pianohat:
             return
-        startup_lights(pygame.display.update)
-        pianohat.on_note(self.handle_note)
-        pianohat.on_octave_up(self.handle_octave_up)
-        pianohat.on_octave_down(self.handle_octave_down)
-        pianohat.on_instrument(self.handle_instrument)
-        pianohat.auto_leds(True)
+        if self.fast_start:
+            startup_lights()
+        else:
+            startup_lights(pygame.display.update)
+        pianohat.on_note(self.hat_note)
+        pianohat.on_octave_up(self.hat_octave_up)
+        pianohat.on_octave_down(self.hat_octave_down)
+        pianohat.on_instrument(self.hat_instrument)
+        if not LEDS.animating():
+            LEDS.auto_leds(True)
         
-    def handle_note(self, channel, pressed):
-        """pianohat.on_note callback
+    def hat_note(self, channel, pressed):
+        """pianohat.on_note callback, queues the event for the main thread"""
+        self.inputs.post('note', channel, pressed)
+    
+    def hat_octave_up(self, channel, pressed):
+        self.inputs.post('octave_up', channel, pressed)
+    
+    def hat_octave_down(self, channel, pressed):
+        self.inputs.post('octave_down', channel, pressed)
+    
+    def hat_instrument(self, channel, pressed):
+        self.inputs.post('instrument', channel, pressed)
+    
+    def handle_inputs(self):
+        """_INPUT_EVENT handler, dispatch the queued input events in order.
+        
+        A run of octave presses only changes the octave once, to where
+        they all end up.
+        """
+        octave = None
+        for timestamp, kind, channel, pressed, note_octave in self.inputs.drain():
+            start = _clock()
+            if kind in ('octave_up', 'octave_down'):
+                if pressed:
+                    if octave is None:
+                        octave = self.octave
+                    else:
+                        self.inputs.coalesced += 1
+                    step = 1 if kind == 'octave_up' else -1
+                    octave = max(0, min(octave + step, self.octaves))
+                continue
+            if octave is not None:
+                self.set_octave(octave)
+                octave = None
+            if kind == 'note':
+                self.handle_note(channel, pressed, timestamp, note_octave)
+            elif kind == 'instrument':
+                self.handle_instrument(channel, pressed)
+            self.inputs.dispatch.add(_clock() - start)
+        if octave is not None:
+            self.set_octave(octave)
+    
+    def handle_note(self, channel, pressed, timestamp=None, octave=None):
+        """Play or release a key, ``timestamp`` is when the key event
+        happened, from ``_clock``, for latency measurements. The key plays
+        in the current octave unless ``octave`` is given.
         """
         if channel < 0 or channel > 12:
             return
-        fill, rect, mask, blend = self.key_blits[channel]
-        if pressed:
-            self.pressed.fill(fill)
-            self.screen.blit(self.pressed, rect, mask, blend)
-            pygame.display.update()
-            msg = self.instrument.note_on(channel, self.octave)
+        if octave is None:
+            octave = self.octave
+        if PROBE.enabled:
+            PROBE.start(self.instrument.name, timestamp if timestamp else _clock())
+            PROBE.mark('handle_note')
+            if pressed:
+                self.rendering.append((self.instrument.name, PROBE.local.timestamp))
+        if self.recorder.recording:
+            self.recorder.record(channel, octave, pressed, self.instrument.name, timestamp)
+        if self.looper and self.looper.recording:
+            self.looper.capture(channel, octave, pressed, timestamp)
+        if self.audio_first:
+            if pressed:
+                if PROBE.enabled:
+                    PROBE.mark('note_on')
+                with self.playing:
+                    msg = self.instrument.note_on(channel, octave)
+                if PROBE.enabled:
+                    PROBE.mark('sounded')
+            else:
+                with self.playing:
+                    msg = self.instrument.note_off(channel, octave)
+            self.renderer.defer(self.draw_key, channel, pressed)
+            self.renderer.defer(self.message, msg)
+        elif pressed:
+            self.draw_key(channel, pressed)
+            self.frame()
+            if PROBE.enabled:
+                PROBE.mark('note_on')
+            with self.playing:
+                msg = self.instrument.note_on(channel, octave)
+            if PROBE.enabled:
+                PROBE.mark('sounded')
             self.message(msg)
         else:
-            msg = self.instrument.note_off(channel, self.octave)
+            with self.playing:
+                msg = self.instrument.note_off(channel, octave)
             self.message(msg)
-            if not mask:
-                mask = (0, 0, self.width_white_key, self.height_keys)
-            full_mask = (rect[0], rect[1], mask[2], mask[3])
-            self.screen.blit(self.key_graphic, rect, full_mask)
-            pygame.display.update()
+            self.draw_key(channel, pressed)
+    
+    def play_note(self, channel, pressed, octave):
+        """Play or release a note now, from the Scheduler thread, for the
+        MidiFilePlayer and Looper. Drawing the key and message is left to
+        the renderer, so a slow frame never delays the note. The note is
+        recorded, but not captured by the Looper.
+        """
+        with self.playing:
+            instrument = self.instrument
+            if self.recorder.recording:
+                self.recorder.record(channel, octave, pressed, instrument.name)
+            if pressed:
+                msg = instrument.note_on(channel, octave)
+            else:
+                msg = instrument.note_off(channel, octave)
+        self.renderer.defer(self.draw_key, channel, pressed)
+        self.renderer.defer(self.message, msg)
+    
+    def frame(self):
+        """_FRAME_EVENT handler, draw the frame and measure how long the
+        keys pressed since the last frame took to show.
+        """
+        self.renderer.frame()
+        if self.rendering:
+            rendering = self.rendering
+            self.rendering = []
+            now = _clock()
+            for name, timestamp in rendering:
+                PROBE.record(name, 'render', now - timestamp)
+    
+    def draw_key(self, channel, pressed):
+        """Highlight the key if pressed, otherwise restore it"""
+        rect, down, up = self.key_sprites[channel]
+        if pressed:
+            self.down.add(channel)
+        else:
+            self.down.discard(channel)
+        sprite = down if pressed else up
+        # a white key's image covers the edges of the black keys beside it,
+        # which are looked up by a bit each, allocating nothing to draw a key
+        held = 0
+        for bit, other in enumerate(self.key_overlaps[channel]):
+            if other in self.down:
+                held |= 1 << bit
+        if held:
+            key = (channel * 2 + pressed) * 4 + held
+            if key not in self.held_sprites:
+                sprite = sprite.copy()
+                for bit, other in enumerate(self.key_overlaps[channel]):
+                    if held & (1 << bit):
+                        other_rect, other_down, other_up = self.key_sprites[other]
+                        sprite.blit(other_down, other_rect.move(-rect.x, -rect.y))
+                self.held_sprites[key] = sprite
+            sprite = self.held_sprites[key]
+        self.renderer.add(self.screen.blit(sprite, rect))
 
     def draw_octaves(self):
         """re-draw the octave meter with the current max octave and octave values
         """
+        octaves = min(self.octaves, 10)
+        sprite = self.octave_sprites.get((octaves, self.octave))
+        if sprite is None:
+            sprite = octave_sprite(self.key_graphic, self.octbar, self.oct_blits,
+                                   octaves, self.octave)
+            self.octave_sprites[octaves, self.octave] = sprite
         octmask = self.oct_blits[0]
-        self.screen.blit(self.key_graphic, (octmask[0], octmask[1]), octmask)
-        for i in xrange(1, min(self.octaves+1, 11)):
-            octmask = self.oct_blits[i]
-            self.octbar.fill((0, 155, 124))
-            if i <= self.octave:
-                self.screen.blit(self.octbar, (octmask[0], octmask[1]), None, pygame.BLEND_ADD)
-            else:
-                self.screen.blit(self.octbar, (octmask[0], octmask[1]), None, pygame.BLEND_SUB)
-        pygame.display.update()
+        self.renderer.add(self.screen.blit(sprite, (octmask[0], octmask[1])))
 
     def handle_octave_up(self, channel, pressed):
         """pianohat.on_octave_up callback
         """
         if not pressed:
             return
-        self.octave = min(self.octave+1, self.octaves)            
-        msg = self.instrument.octave_up(self.octave)
-        self.draw_octaves()
-        if msg is None:
-            msg = "octave up: " + str(self.octave)
-        self.message(msg)
+        self.set_octave(min(self.octave+1, self.octaves))
         
     def handle_octave_down(self, channel, pressed):
         """pianohat.on_octave_down callback
         """
         if not pressed:
             return
-        self.octave = max(self.octave-1, 0)
-        msg = self.instrument.octave_down(self.octave)
+        self.set_octave(max(self.octave-1, 0))
+    
+    def set_octave(self, octave):
+        """Move to ``octave``, telling the instrument it went up or down"""
+        with self.playing:
+            if octave >= self.octave:
+                self.octave = octave
+                msg = self.instrument.octave_up(self.octave)
+                direction = "up"
+            else:
+                self.octave = octave
+                msg = self.instrument.octave_down(self.octave)
+                direction = "down"
         self.draw_octaves()
         if msg is None:
-            msg = "octave down: " + str(self.octave)
+            msg = "octave {}: {}".format(direction, self.octave)
         self.message(msg)
 
     def handle_instrument(self, channel, pressed):
@@ -277,12 +1359,9 @@ class PiPianoUI():
         if not isinstance(message, (str, unicode)):
             return
         inst = '' if not self.instrument else self.instrument.name + ' '
-        print(inst+message)
-        t = self.font.render(inst+message, 2, (0, 0, 0))
-        self.console.fill((255, 255, 255))
-        self.console.blit(t, (0, 0))
-        self.screen.blit(self.console, (5, self.height_keys+5))
-        pygame.display.update()
+        CONSOLE.write(inst+message)
+        self.console = self.text.get(inst+message)
+        self.renderer.add(self.screen.blit(self.console, (5, self.height_keys+5)))
     
     def add_instrument(self, instrument):
         """Add an instance of Instrument to set of available instruments to be cycled through
@@ -296,13 +1375,17 @@ class PiPianoUI():
         """
         if index < 0 or index > len(self.instruments):
             return
-        if self.instrument:
-            self.instrument.deselect()
-        self.instrument = self.instruments[index]
-        self.instrument_index = index
-        self.octaves = self.instrument.octaves
-        self.octave = self.instrument.initial_octave
-        m = self.instrument.select()
+        with self.playing:
+            if self.instrument:
+                self.instrument.deselect()
+            instrument = self.instruments[index]
+            if isinstance(instrument, LazyInstrument):
+                instrument = self.instruments[index] = instrument.build()
+            self.instrument = instrument
+            self.instrument_index = index
+            self.octaves = self.instrument.octaves
+            self.octave = self.instrument.initial_octave
+            m = self.instrument.select()
         self.message(m if m else '') # change the instrument name
         self.draw_octaves()
         
@@ -318,11 +1401,15 @@ class PiPianoUI():
                     index = i
         elif isinstance(name_or_index, int):
             index = name_or_index
-        if index is None:
+        if index is None or index < 0 or index >= len(self.instruments):
             return
+        instrument = self.instruments.pop(index)
+        self.message('Removed instrument: '+ instrument.name)
         if self.instrument_index == index:
-            self.instruments.pop(index)
             self.set_instrument(0)
+        elif self.instrument_index > index:
+            self.instrument_index -= 1
+        return instrument
 
 _KEYS = 'C,C#,D,D#,E,F,F#,G,G#,A,A#,B,C,octave_down,octave_up,insturment'.split(',')
 def key_name(channel):
@@ -405,120 +1492,1696 @@ class Instrument:
 def natural_sort_key(s, _nsre=re.compile('([0-9]+)')):
     return [int(text) if text.isdigit() else text.lower() for text in re.split(_nsre, s)]
 
-class WavPlayer(Instrument):
-    """Example wav file player.
+class VoiceAllocator(object):
+    """Decides which mixer channel plays each note, and keeps track of it.
     
-    This is based on code from:
-    https://github.com/pimoroni/Piano-HAT/blob/master/examples/simple-piano.py
-    
-    When given a directory and file types, it will load those files into
-    list of pygame samples to be played when the appropriate key is pressed.
+    Voices are recorded against a key, the (channel, octave) of the note
+    for the instruments, so they can be released when the key is. When
+    every channel is busy a voice is stolen according to ``policy``:
     
-    The files mapped in order by their filenames. This assumes a 12 notes
-    per octave with the first note being 'C'. The last key (the 13th) is
-    the 'C' note for the next octave.
+        oldest     the voice that started first
+        quietest   the voice with the lowest volume
+        retrigger  a key played again replaces its own voices first,
+                   otherwise the oldest voice is stolen
     
-    The initial_octave is the middle octave detected.
+    Voices already released (fading out) are always stolen before held
+    ones. Channels below ``first`` are left for others, such as the Songs
+    streams.
     
-    This plays short wav samples. A good source of such samples can be found at:
-    https://freesound.org/
+    A note made of several sounds plays the rest with ``retrigger`` False,
+    so they do not replace the first.
     """
-    def __init__(self, folder, filetypes=('*.wav', '*.ogg'), loop=0):
-        self.name = 'WavPlayer:'+os.path.basename(folder)
-        self.folder = folder
-        self.loop = loop
-        self.files = []
-        for filetype in filetypes:
-            self.files.extend(glob.glob(os.path.join(folder, filetype)))
-        self.files.sort(key=natural_sort_key)
-        self.octaves = 0
-        self.initial_octave = 0
-        if self.files:
-            self.octaves = int(len(self.files) / 12)
-            self.initial_octave = int(self.octaves / 2)
-        self.samples = []
-        
-    def note_on(self, channel, octave):
-        """Play the sample for the current key and octave.
-        """
-        ind = channel + (octave*12)
-        if ind >= len(self.samples):
-            return ''
-        self.samples[ind].play(loops=self.loop)
-        return os.path.basename(self.files[ind])
-        
-    def select(self):
-        """Initialize the pygame mixer, and load the samples from files.
-        """
-        if pianohat:
-            pianohat.auto_leds(True)
-        pygame.mixer.pre_init(44100, -16, 1, 512)
-        pygame.mixer.init()
-        pygame.mixer.set_num_channels(32)
-        self.samples = [pygame.mixer.Sound(sample) for sample in self.files]
-
-    def deselect(self):
-        """Stop the pygame mixer, and quit it so others can initialize it with
-        different settings.
-        """
-        samples = self.samples
-        self.samples = []
-        pygame.mixer.stop()
-        pygame.mixer.quit()
-        del samples
+    POLICIES = ('oldest', 'quietest', 'retrigger')
+    
+    def __init__(self, policy='oldest'):
+        if policy not in self.POLICIES:
+            raise ValueError("Unknown voice stealing policy: {}".format(policy))
+        self.policy = policy
+        self.channels = []
+        self.slots = []
+        self.keys = dict()
+        self.first = 0
+        self.lock = threading.Lock()
+        self.plays = 0
+        self.steals = 0
+        self.retriggers = 0
+        self.peak = 0
+    
+    def attach(self, num_channels):
+        """Use mixer channels up to ``num_channels``, after the mixer opens"""
+        with self.lock:
+            self.channels = [pygame.mixer.Channel(i) for i in xrange(num_channels)]
+            self.slots = [None] * num_channels
+            self.keys = dict()
+    
+    def reserve(self, first):
+        """Leave channels below ``first`` alone"""
+        with self.lock:
+            self.first = first
+    
+    def play(self, key, sound, loops=0, fade_ms=0, retrigger=True):
+        """Play ``sound`` on a free channel, or a stolen one, for ``key``"""
+        with self.lock:
+            if retrigger and self.policy == 'retrigger':
+                for i in self.keys.pop(key, ()):
+                    if self.slots[i]:
+                        self.channels[i].stop()
+                        self.slots[i] = None
+                        self.retriggers += 1
+            i = self.free()
+            if i is None:
+                i = self.steal()
+                self.steals += 1
+            old = self.slots[i]
+            if old:
+                self.keys.get(old[0], set()).discard(i)
+            self.slots[i] = [key, sound, time.time(), False]
+            self.keys.setdefault(key, set()).add(i)
+            self.plays += 1
+            channel = self.channels[i]
+            # started with the lock held, so no other thread finds it free
+            channel.play(sound, loops, fade_ms=fade_ms)
+        active = self.active()
+        if active > self.peak:
+            self.peak = active
+        return channel
+    
+    def release(self, key, fade_ms=0):
+        """Stop, or fade out, the voices still playing for ``key``"""
+        with self.lock:
+            for i in self.keys.pop(key, ()):
+                slot = self.slots[i]
+                if not slot or not self.channels[i].get_busy():
+                    continue
+                slot[3] = True
+                if fade_ms:
+                    self.channels[i].fadeout(fade_ms)
+                else:
+                    self.channels[i].stop()
+    
+    def free(self):
+        for i in xrange(self.first, len(self.channels)):
+            if not self.channels[i].get_busy():
+                return i
+        return None
+    
+    def steal(self):
+        """Pick the voice to stop, with the lock held"""
+        candidates = [i for i in xrange(self.first, len(self.channels)) if self.slots[i]]
+        if not candidates:
+            return self.first
+        if self.policy == 'quietest':
+            rank = lambda i: (not self.slots[i][3],
+                              self.channels[i].get_volume() * self.slots[i][1].get_volume())
+        else:
+            rank = lambda i: (not self.slots[i][3], self.slots[i][2])
+        i = min(candidates, key=rank)
+        self.channels[i].stop()
+        return i
+    
+    def active(self):
+        """Number of voices playing"""
+        return sum(1 for i, slot in enumerate(self.slots)
+                   if slot and self.channels[i].get_busy())
+    
+    def stats(self):
+        return dict(policy=self.policy, active=self.active(), peak=self.peak,
+                    plays=self.plays, steals=self.steals, retriggers=self.retriggers)
+    
+    def __str__(self):
+        return 'voices {active} active {peak} peak {steals} stolen {retriggers} retriggered'.format(
+            **self.stats())
 
-class Songs(WavPlayer):
-    """Example sound board style music player for playing longer mp3 tracks.
-    When holding down the specific key. Multiple songs can be mixed at once.
+class SoftwareMixer(object):
+    """Mix voices in numpy a block at a time onto a single mixer channel.
     
-    Songs are mapped the same way they are with the WavPlayer.
+    Sources are registered once and copied into one pool array, at ``bits``,
+    or the mixer's bit depth if not given; 8 bits halves the pool, while
+    the blocks played stay in the mixer format. Mono sources stay one channel in the pool and are
+    spread over the mixer channels as they play. Sources no longer needed
+    are unregistered, and the pool is compacted once half of it is unused.
+    Each block gathers the frames of every active voice from the pool,
+    applies its ADSR envelope, gain and pan, and sums them in one
+    vectorized pass. A thread keeps the output channel double
+    buffered, queueing the next block behind the one playing.
+    
+    Envelopes are ``(attack, decay, sustain, release)`` with times in
+    seconds and sustain a level between 0.0 and 1.0, and are applied per
+    frame, so attack and release are sample accurate.
     
-    Octaves modify the song speed from 0 to 10, with 4 being normal speed.
-    Depending on the bitrate, some mp3 songs will cycle in speed across the
-    octave setting range.
+    The time to render each block is kept in a Histogram, and blocks
+    which took longer than they last to play are counted as late.
     """
-    def __init__(self, folder, filetypes=('*.mp3',), loop=0):
-        WavPlayer.__init__(self, folder, filetypes, loop)
+    def __init__(self, channel, mixer_format, block=512, bits=None):
+        self.channel = channel
+        self.format = mixer_format
+        self.rate = mixer_format[0]
+        self.channels = mixer_format[2]
+        self.block = block
+        self.deadline = float(block) / self.rate
+        self.bits = bits or abs(mixer_format[1])
+        self.scale = 2 ** (self.bits - 1)
+        self.pool = numpy.zeros(0, numpy.int8 if self.scale == 128 else numpy.int16)
+        self.used = 0
+        self.unused = 0
+        self.sources = dict()
+        self.voices = []
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.running = False
+        self.thread = None
+        self.render_time = Histogram()
+        self.blocks = 0
+        self.late = 0
+        self.underruns = 0
+    
+    def register(self, key, frames):
+        """Add a source, float frames between -1.0 and 1.0, under ``key``"""
+        if key in self.sources:
+            return self.sources[key]
+        if frames.ndim == 1:
+            frames = frames[:, numpy.newaxis]
+        if frames.shape[1] > 1:
+            frames = match_channels(frames, self.channels)
+        samples = numpy.round(frames * (self.scale - 1)).astype(self.pool.dtype).ravel()
+        with self.lock:
+            if self.used + len(samples) > len(self.pool):
+                # grow by doubling so registering is amortized constant time
+                pool = numpy.zeros(max(2 * len(self.pool), self.used + len(samples)),
+                                   self.pool.dtype)
+                pool[:self.used] = self.pool[:self.used]
+                self.pool = pool
+            self.pool[self.used:self.used + len(samples)] = samples
+            self.sources[key] = (self.used, len(frames), frames.shape[1])
+            self.used += len(samples)
+        return self.sources[key]
+    
+    def unregister(self, keys):
+        """Drop the sources under ``keys``, and the voices playing them"""
+        with self.lock:
+            for key in keys:
+                source = self.sources.pop(key, None)
+                if source:
+                    self.unused += source[1] * source[2]
+            self.voices = [v for v in self.voices if v['source'] in self.sources]
+            if self.unused * 2 > self.used:
+                self.compact()
+    
+    def compact(self):
+        """Copy the sources still registered into a new pool, with the lock held"""
+        pool = numpy.zeros(self.used - self.unused, self.pool.dtype)
+        used = 0
+        for key, (offset, length, channels) in self.sources.items():
+            size = length * channels
+            pool[used:used + size] = self.pool[offset:offset + size]
+            self.sources[key] = (used, length, channels)
+            used += size
+        for voice in self.voices:
+            voice['offset'] = self.sources[voice['source']][0]
+        self.pool = pool
+        self.used = used
+        self.unused = 0
+    
+    def note_on(self, key, source, gain=1.0, pan=0.0, loops=0,
+                envelope=(0.0, 0.0, 1.0, 0.0)):
+        """Start a voice for ``key`` playing the registered ``source``,
+        repeated ``loops`` more times as with pygame, or forever with -1.
+        """
+        offset, length, channels = self.sources[source]
+        angle = (pan + 1) * numpy.pi / 4
+        pans = [numpy.cos(angle), numpy.sin(angle)] if self.channels == 2 else [1.0] * self.channels
+        attack, decay, sustain, release = envelope
+        voice = dict(key=key, source=source, offset=offset, length=length, channels=channels,
+                     loops=loops, pos=0,
+                     gain=numpy.array(pans) * gain * (numpy.sqrt(2) if self.channels == 2 else 1),
+                     attack=attack * self.rate, decay=decay * self.rate, sustain=sustain,
+                     release=release * self.rate, released=numpy.inf)
+        with self.lock:
+            self.voices.append(voice)
+        self.start()
+        return voice
+    
+    def note_off(self, key):
+        """Start the release of the voices playing for ``key``"""
+        with self.lock:
+            for voice in self.voices:
+                if voice['key'] == key and voice['released'] == numpy.inf:
+                    voice['released'] = voice['pos']
+    
+    def clear(self):
+        with self.lock:
+            self.voices = []
+    
+    def envelope(self, t, attack, decay, sustain):
+        """Attack and decay levels, for frame ages ``t``"""
+        rising = t / numpy.maximum(attack, 1)
+        falling = 1 - (1 - sustain) * (t - attack) / numpy.maximum(decay, 1)
+        return numpy.where(t < attack, rising, numpy.maximum(falling, sustain))
+    
+    def render(self):
+        """Mix the next block of all the voices, as float frames"""
+        column = lambda name: numpy.array([v[name] for v in voices])[:, numpy.newaxis]
+        with self.lock:
+            voices = list(self.voices)
+            pool = self.pool
+            # compacting moves the sources, so read the offsets with the pool
+            offset = column('offset') if voices else None
+        if not voices:
+            return numpy.zeros((self.block, self.channels), numpy.float32)
+        frame = numpy.arange(self.block)
+        length, pos = column('length'), column('pos')
+        attack, decay, sustain = column('attack'), column('decay'), column('sustain')
+        release, released = column('release'), column('released')
+        loops, channels = column('loops'), column('channels')
+        t = pos + frame
+        playing = (loops < 0) | (t < length * (loops + 1))
+        index = offset + channels * numpy.where(playing, t % length, length - 1)
+        level = self.envelope(t, attack, decay, sustain)
+        # fade from the level the voice had when released
+        start = self.envelope(numpy.minimum(released, 1e12), attack, decay, sustain)
+        fading = start * (1 - (t - released) / numpy.maximum(release, 1))
+        level = numpy.where(t >= released, numpy.maximum(fading, 0), level) * playing
+        gains = numpy.array([v['gain'] for v in voices])
+        # mono sources read their one channel for every mixer channel
+        spread = (channels > 1)[:, :, numpy.newaxis] * numpy.arange(self.channels)
+        frames = pool[index[:, :, numpy.newaxis] + spread].astype(numpy.float32) / self.scale
+        out = numpy.einsum('vbc,vb,vc->bc', frames, level.astype(numpy.float32),
+                           gains.astype(numpy.float32))
+        done = (~playing[:, -1]) | (t[:, -1] >= released[:, 0] + release[:, 0])
+        with self.lock:
+            for voice in voices:
+                voice['pos'] += self.block
+            finished = set(id(v) for v, d in zip(voices, done) if d)
+            self.voices = [v for v in self.voices if id(v) not in finished]
+        return numpy.clip(out, -1, 1)
+    
+    def start(self):
+        if not self.running:
+            self.running = True
+            self.thread = threading.Thread(target=self.run, name='SoftwareMixer')
+            self.thread.daemon = True
+            self.thread.start()
+        self.wake.set()
+    
+    def stop(self):
+        self.running = False
+        self.wake.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+    
+    def run(self):
+        while self.running:
+            if not self.voices and not self.channel.get_busy():
+                self.wake.wait()
+                self.wake.clear()
+                continue
+            if self.channel.get_busy() and self.channel.get_queue() is not None:
+                self.wake.wait(self.deadline / 4)
+                self.wake.clear()
+                continue
+            started = _clock()
+            sound = pygame.sndarray.make_sound(mixer_array(self.render(), self.format))
+            took = _clock() - started
+            self.render_time.add(took)
+            self.blocks += 1
+            if took > self.deadline:
+                self.late += 1
+            if self.channel.get_busy():
+                self.channel.queue(sound)
+            else:
+                if self.blocks > 1:
+                    self.underruns += 1
+                self.channel.play(sound)
+    
+    def stats(self):
+        return dict(blocks=self.blocks, late=self.late, underruns=self.underruns,
+                    deadline=self.deadline, render=self.render_time.summary(),
+                    voices=len(self.voices), sources=len(self.sources),
+                    pool_bytes=self.used * self.pool.itemsize)
+    
+    def __str__(self):
+        render = self.render_time.summary()
+        return 'mixer {} blocks p99 {:.2f}ms max {:.2f}ms of {:.2f}ms, {} late {} underruns'.format(
+            self.blocks, render['p99'] * 1000, render['max'] * 1000, self.deadline * 1000,
+            self.late, self.underruns)
+
+class AudioEngine(object):
+    """The one pygame mixer configuration shared by every instrument.
+    
+    The mixer is opened once with ``start`` and stays open while switching
+    instruments, reopening the audio device is slow and glitches. Samples
+    are converted to this format when they are loaded, by pygame when
+    decoding files and by the Wavetable for generated waves, so every
+    instrument can play on the same mixer.
+    
+    Instruments play their notes through the VoiceAllocator ``voices``,
+    or through the optional SoftwareMixer, which takes the last channel.
+    ``sample_bits`` is the bit depth the SoftwareMixer keeps its sources at,
+    the mixer's own when None.
+    """
+    def __init__(self, frequency=44100, size=-16, channels=2, buffer=512,
+                 num_channels=32, policy='oldest', sample_bits=None):
+        self.config = (frequency, size, channels, buffer)
+        self.sample_bits = sample_bits
+        self.num_channels = num_channels
+        self.format = None
+        self.opened = 0
+        self.voices = VoiceAllocator(policy)
+        self.software = None
+    
+    def pre_init(self):
+        """Call before pygame.init so it opens the mixer in our format"""
+        pygame.mixer.pre_init(*self.config)
+    
+    def start(self):
+        """Open the mixer if needed, returns the mixer format"""
+        current = pygame.mixer.get_init()
+        if current and current == (self.format or self.config[:3]):
+            if not self.format:
+                pygame.mixer.set_num_channels(self.num_channels)
+                self.voices.attach(self.num_channels)
+            self.format = current
+            return current
+        self.open(*self.config)
+        return self.format
+    
+    def open(self, frequency, size, channels, buffer):
+        if pygame.mixer.get_init():
+            pygame.mixer.stop()
+            pygame.mixer.quit()
+        if self.software:
+            self.software.stop()
+            self.software = None
+        pygame.mixer.init(frequency, size, channels, buffer)
+        pygame.mixer.set_num_channels(self.num_channels)
+        self.voices.attach(self.num_channels)
+        self.opened += 1
+        # the device may not give us exactly what we asked for
+        self.format = pygame.mixer.get_init()
+    
+    def stop(self):
+        """Stop everything playing, leaving the mixer open"""
+        if self.software:
+            self.software.clear()
+        if pygame.mixer.get_init():
+            pygame.mixer.stop()
+    
+    def software_mixer(self, block=512):
+        """The SoftwareMixer, started on the engine's last channel the
+        first time it is asked for.
+        """
+        mixer_format = self.start()
+        if not self.software:
+            self.voices.attach(self.num_channels - 1)
+            self.software = SoftwareMixer(pygame.mixer.Channel(self.num_channels - 1),
+                                          mixer_format, block, self.sample_bits)
+        return self.software
+    
+    def reserve(self, count):
+        """Keep the first ``count`` channels out of the VoiceAllocator"""
+        pygame.mixer.set_reserved(count)
+        self.voices.reserve(count)
+    
+    def quit(self):
+        if self.software:
+            self.software.stop()
+            self.software = None
+        if pygame.mixer.get_init():
+            pygame.mixer.quit()
+        self.format = None
+
+ENGINE = AudioEngine()
+
+class SampleCache(object):
+    """Process wide LRU cache of decoded pygame Sounds.
+    
+    Sounds are keyed by the file path, modification time and the pygame
+    mixer format, so an edited file or a different mixer setup is decoded
+    again, and by a ``variant`` naming how the Sound was processed. Once
+    the decoded audio goes over ``budget`` bytes the least recently used
+    Sounds are dropped.
+    
+    Instruments share the module level SAMPLE_CACHE so switching away from
+    an instrument and back again does not decode the files from disk again.
+    """
+    def __init__(self, budget=64*1024*1024):
+        self.budget = budget
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+    
+    def key(self, path, variant=None):
+        return (os.path.abspath(path), os.path.getmtime(path), pygame.mixer.get_init(), variant)
+    
+    def get(self, path, load=None, variant=None):
+        """Get the Sound for ``path``, decoding it with ``load`` (by default
+        pygame.mixer.Sound) on a miss.
+        """
+        key = self.key(path, variant)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry:
+                self.entries[key] = entry
+                self.hits += 1
+                return entry[0]
+        # decode outside the lock so several loaders can work at once
+        sound = (load if load else pygame.mixer.Sound)(path)
+        freq, size, channels = key[2]
+        nbytes = int(sound.get_length() * freq) * channels * abs(size) // 8
+        with self.lock:
+            self.misses += 1
+            if key not in self.entries:
+                self.entries[key] = (sound, nbytes)
+                self.bytes += nbytes
+                self.evict()
+        return sound
+    
+    def evict(self):
+        """Drop least recently used Sounds until under budget"""
+        while self.bytes > self.budget and self.entries:
+            key, (sound, nbytes) = self.entries.popitem(last=False)
+            self.bytes -= nbytes
+            self.evictions += 1
+    
+    def set_budget(self, budget):
+        with self.lock:
+            self.budget = budget
+            self.evict()
+    
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+    
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                    samples=len(self.entries), bytes=self.bytes, budget=self.budget)
+    
+    def __str__(self):
+        return 'cache {} hits {} misses {:.1f}/{:.0f}MB'.format(
+            self.hits, self.misses, self.bytes / 1048576.0, self.budget / 1048576.0)
+
+SAMPLE_CACHE = SampleCache()
+
+class SampleBank(object):
+    """A folder of samples compiled into a single memory-mapped file.
+    
+    The bank holds the raw PCM of every sample already converted to the
+    pygame mixer format, and a JSON index of each note's offset and length
+    in the file. Sounds are built straight from the mapped PCM, with no
+    file opening, parsing or conversion per sample.
+    
+    The index also records the size and modification time of the source
+    files, the mixer format, and the SampleReducer stats if the samples
+    were reduced, so ``valid`` can tell when the bank needs to be rebuilt.
+    
+    File layout::
+    
+        MAGIC, uint32 index length, JSON index, padding, PCM data
+    """
+    MAGIC = b'PPUIBANK'
+    ALIGN = 4096
+    FILENAME = '.pipianoui.bank'
+    
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(len(self.MAGIC)) != self.MAGIC:
+                raise ValueError("Not a sample bank: " + path)
+            (size,) = struct.unpack('<I', f.read(4))
+            self.index = json.loads(f.read(size).decode('utf-8'))
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.format = tuple(self.index['format'])
+        self.names = dict((source[0], i) for i, source in enumerate(self.index['sources']))
+    
+    @staticmethod
+    def sources(files):
+        return [[os.path.basename(f), os.path.getsize(f), os.path.getmtime(f)] for f in files]
+    
+    @classmethod
+    def build(cls, path, files, samples, mixer_format, reduced=None):
+        """Write a bank for ``files`` from their decoded ``samples``.
+        
+        The bank is written next to its final path and renamed into place,
+        so a bank being read is never half written.
+        """
+        raws = [sample.get_raw() for sample in samples]
+        index = dict(version=1, format=list(mixer_format),
+                     sources=cls.sources(files), entries=[], reduced=reduced)
+        # the offsets depend on the index size, so size it with place holders
+        header = len(cls.MAGIC) + 4 + len(json.dumps(dict(index, entries=[[0xffffffff, len(r)] for r in raws])))
+        offset = header + (-header % cls.ALIGN)
+        for raw in raws:
+            index['entries'].append([offset, len(raw)])
+            offset += len(raw)
+        data = json.dumps(index).encode('utf-8')
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(cls.MAGIC)
+            f.write(struct.pack('<I', len(data)))
+            f.write(data)
+            f.write(b'\0' * (index['entries'][0][0] - f.tell() if raws else 0))
+            for raw in raws:
+                f.write(raw)
+        os.rename(tmp, path)
+    
+    @classmethod
+    def open(cls, path, files, mixer_format, reduced=None):
+        """Open the bank at ``path`` if it is up to date for ``files``, the
+        mixer format and the SampleReducer ``key``, otherwise return None.
+        """
+        if not os.path.exists(path):
+            return None
+        try:
+            bank = cls(path)
+        except (IOError, ValueError) as e:
+            print("Error: couldn't read sample bank: {} {}".format(path, e))
+            return None
+        if not bank.valid(files, mixer_format, reduced):
+            bank.close()
+            return None
+        return bank
+    
+    def valid(self, files, mixer_format, reduced=None):
+        return (self.format == tuple(mixer_format) and
+                self.index['sources'] == self.sources(files) and
+                (self.index.get('reduced') or {}).get('key') == reduced)
+    
+    def load(self, path):
+        """Build the Sound for a source file path from the mapped PCM"""
+        offset, length = self.index['entries'][self.names[os.path.basename(path)]]
+        return pygame.mixer.Sound(buffer=_buffer(self.map, offset, length))
+    
+    def close(self):
+        self.map.close()
+
+def build_sample_bank(folder, filetypes=('*.wav', '*.ogg')):
+    """Compile the samples in ``folder`` into a SampleBank for the WavPlayer.
+    """
+    player = WavPlayer(folder, filetypes)
+    mixer_format = ENGINE.start()
+    samples = [pygame.mixer.Sound(f) for f in player.files]
+    path = os.path.join(folder, SampleBank.FILENAME)
+    SampleBank.build(path, player.files, samples, mixer_format)
+    ENGINE.quit()
+    print("Built {} with {} samples".format(path, len(samples)))
+    return path
+
+class SampleLoader(object):
+    """Load sample files into pygame Sounds on a pool of worker threads.
+    
+    Files are laid out 12 per octave as with the WavPlayer. Samples for the
+    given octave are loaded first, then the octaves around it moving outward.
+    ``prioritize`` re-orders what is still waiting when the octave changes.
+    
+    ``samples`` is filled in as files finish loading, with None for samples
+    which are still waiting or failed to load. ``progress`` is called from
+    the worker threads with the loader after each file.
+    """
+    def __init__(self, files, load=None, progress=None, workers=2):
+        self.files = files
+        self.load = load if load else pygame.mixer.Sound
+        self.progress = progress
+        self.workers = workers
+        self.samples = [None] * len(files)
+        self.failed = set()
+        self.pending = set(xrange(len(files)))
+        self.loaded = 0
+        self.generation = 0
+        self.cancelled = False
+        self.queue = queue.PriorityQueue()
+        self.lock = threading.Lock()
+        self.threads = []
+    
+    def start(self, octave=0):
+        """Queue all the files and start the workers"""
+        self.prioritize(octave)
+        for i in xrange(min(self.workers, len(self.files))):
+            t = threading.Thread(target=self.worker, name='SampleLoader-{}'.format(i))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+        return self
+    
+    def prioritize(self, octave):
+        """Load the samples closest to ``octave`` next.
+        
+        Entries queued by an earlier call are left in the queue, and skipped
+        by the workers once the sample is loaded.
+        """
+        with self.lock:
+            self.generation += 1
+            for i in self.pending:
+                self.queue.put((-self.generation, abs(int(i / 12) - octave), i))
+    
+    def worker(self):
+        while not self.cancelled:
+            try:
+                i = self.queue.get_nowait()[2]
+            except queue.Empty:
+                return
+            with self.lock:
+                if i not in self.pending:
+                    continue
+                self.pending.discard(i)
+            try:
+                sample = self.load(self.files[i])
+            except (pygame.error, IOError, OSError) as e:
+                print("Error: couldn't load sample: {} {}".format(self.files[i], e))
+                self.failed.add(i)
+            else:
+                self.samples[i] = sample
+            with self.lock:
+                self.loaded += 1
+            if self.progress and not self.cancelled:
+                self.progress(self)
+    
+    def done(self):
+        return self.loaded >= len(self.files)
+    
+    def cancel(self):
+        """Stop loading, waiting only for files already being decoded"""
+        self.cancelled = True
+        for t in self.threads:
+            t.join()
+        self.threads = []
+
+class SampleReducer(object):
+    """Shrink samples as they are decoded, to fit more of them in memory.
+    
+    Silence quieter than ``threshold_db`` below full scale is trimmed from
+    the start and end of each sample, and with ``mono`` stereo samples
+    whose channels are identical are folded to one channel. Both work on
+    the whole sample array at once in numpy.
+    
+    pygame Sounds are always in the mixer format, so for Sounds only the
+    trimming saves memory. Folding is for the SoftwareMixer, which keeps
+    folded samples as one channel in its pool, at ``bits`` if given, the
+    SoftwareMixer's bit depth, otherwise the mixer's.
+    
+    ``before`` counts the bytes of each file at its own width and channels,
+    and ``after`` the bytes held once trimmed, folded and converted to
+    ``bits``, for reporting what was saved.
+    """
+    def __init__(self, threshold_db=-60.0, mono=False, bits=None):
+        self.threshold_db = threshold_db
+        self.threshold = 10 ** (threshold_db / 20.0)
+        self.mono = mono
+        self.bits = bits
+        self.key = 'trim {:g}dB{}{}'.format(threshold_db, ' mono' if mono else '',
+                                            ' {}bit'.format(bits) if bits else '')
+        self.files = 0
+        self.trimmed = 0
+        self.folded = 0
+        self.before = 0
+        self.after = 0
+        self.lock = threading.Lock()
+    
+    def trim(self, frames):
+        """``frames`` without the silence at the start and end"""
+        loud = numpy.flatnonzero(numpy.abs(frames).max(axis=1) > self.threshold)
+        if not len(loud):
+            return frames[:1]
+        return frames[loud[0]:loud[-1] + 1]
+    
+    def foldable(self, frames):
+        return (self.mono and frames.shape[1] > 1 and
+                not (frames != frames[:, :1]).any())
+    
+    def fold(self, frames):
+        """``frames`` as one channel if every channel is the same"""
+        return frames[:, :1] if self.foldable(frames) else frames
+    
+    def sound(self, sound, mixer_format, path=None):
+        """Trim a decoded Sound, counting the bytes saved against the
+        file at ``path``.
+        """
+        frames = sound_frames(sound, mixer_format)
+        trimmed = self.trim(frames)
+        width = (self.bits or abs(mixer_format[1])) // 8
+        before = frames.size * abs(mixer_format[1]) // 8
+        if path and path.lower().endswith('.wav'):
+            try:
+                w = wave.open(path, 'rb')
+                try:
+                    before = w.getnframes() * w.getnchannels() * w.getsampwidth()
+                finally:
+                    w.close()
+            except (wave.Error, EOFError, IOError, OSError):
+                pass
+        folded = self.foldable(trimmed)
+        with self.lock:
+            self.files += 1
+            self.before += before
+            self.after += (trimmed[:, :1] if folded else trimmed).size * width
+            if len(trimmed) < len(frames):
+                self.trimmed += 1
+            if folded:
+                self.folded += 1
+        if len(trimmed) == len(frames):
+            return sound
+        return pygame.sndarray.make_sound(mixer_array(trimmed, mixer_format))
+    
+    def restore(self, stats):
+        """Take the counts from an earlier run, kept in a SampleBank"""
+        for name in ('files', 'trimmed', 'folded', 'before', 'after'):
+            setattr(self, name, stats.get(name, 0))
+    
+    def stats(self):
+        return dict(key=self.key, files=self.files, trimmed=self.trimmed,
+                    folded=self.folded, before=self.before, after=self.after,
+                    saved=self.before - self.after)
+    
+    def __str__(self):
+        saved = self.before - self.after
+        return 'trimmed {} of {} samples {:.1f} -> {:.1f}MB, {} {:.1f}MB ({:.0f}%){}'.format(
+            self.trimmed, self.files, self.before / 1048576.0, self.after / 1048576.0,
+            'saved' if saved >= 0 else 'grew', abs(saved) / 1048576.0,
+            100.0 * abs(saved) / self.before if self.before else 0.0,
+            ', {} folded to mono'.format(self.folded) if self.folded else '')
+
+_NOTE_NAME = re.compile(r'(?:^|[^A-Za-z])([A-Ga-g])([#sb]?)(-?\d)(?![\d])')
+_SEMITONES = dict(c=0, d=2, e=4, f=5, g=7, a=9, b=11)
+
+def sample_notes(files, step=1, first_note=24):
+    """The note each sample file was recorded at.
+    
+    When every file name has a note name and octave, such as ``A4``,
+    ``C#3`` or ``Bb-1``, those are used, with ``A4`` being note 69. Otherwise
+    the files are taken to be ``step`` semitones apart, in order, starting
+    from ``first_note``, which is C1 by default. Starting on a C, the files
+    fall on the same keys as they do without pitch shifting, where the first
+    file is the C of the lowest octave.
+    """
+    notes = []
+    for path in files:
+        found = _NOTE_NAME.findall(os.path.splitext(os.path.basename(path))[0])
+        if not found:
+            return [first_note + i * step for i in xrange(len(files))]
+        name, accidental, octave = found[-1]
+        note = (int(octave) + 1) * 12 + _SEMITONES[name.lower()]
+        notes.append(note + {'#': 1, 's': 1, 'b': -1}.get(accidental, 0))
+    return notes
+
+class WavPlayer(Instrument):
+    """Example wav file player.
+    
+    This is based on code from:
+    https://github.com/pimoroni/Piano-HAT/blob/master/examples/simple-piano.py
+    
+    When given a directory and file types, it will load those files into
+    list of pygame samples to be played when the appropriate key is pressed.
+    
+    The files mapped in order by their filenames. This assumes a 12 notes
+    per octave with the first note being 'C'. The last key (the 13th) is
+    the 'C' note for the next octave.
+    
+    The initial_octave is the middle octave detected.
+    
+    Samples are loaded in the background by a SampleLoader when selected,
+    starting with the current octave. Keys are playable as soon as their
+    sample has loaded. Decoded samples are kept in the SAMPLE_CACHE.
+    
+    With ``bank`` set the samples are read from a SampleBank in the folder,
+    which is (re)built after the files have been loaded whenever it is
+    missing or out of date.
+    
+    Samples play until they end, unless ``release_ms`` is set, in which
+    case releasing the key fades the sample out over that time.
+    
+    With ``software`` the samples are played by the engine's SoftwareMixer
+    rather than on mixer channels of their own.
+    
+    ``files`` is the sorted list of samples, from a SoundIndex, instead of
+    finding the ``filetypes`` in the folder.
+    
+    With ``pitch_shift`` the folder needs only a few samples, say one every
+    third or every octave, and any note over 10 octaves is played by
+    resampling the sample recorded nearest to it. The notes of the samples
+    are found by ``sample_notes``, passed ``step`` and ``first_note``. The
+    most recently played ``note_cache`` shifted notes are kept. Notes are
+    shifted by one background worker, the notes of the current octave ahead
+    of time; a key whose note isn't shifted yet is queued first and plays
+    as soon as it is, so the key handling never waits on resampling.
+    
+    With a SampleReducer as ``reducer`` the samples are trimmed, and folded
+    to mono for the SoftwareMixer, as they are loaded. What it saved is
+    reported when loading finishes.
+    
+    This plays short wav samples. A good source of such samples can be found at:
+    https://freesound.org/
+    """
+    def __init__(self, folder, filetypes=('*.wav', '*.ogg'), loop=0, workers=2,
+                 bank=True, release_ms=None, software=False, files=None,
+                 pitch_shift=False, step=1, first_note=24, note_cache=48, reducer=None):
+        self.name = 'WavPlayer:'+os.path.basename(folder)
+        self.software = software
+        self.mixer = None
+        self.folder = folder
+        self.loop = loop
+        self.release_ms = release_ms
+        self.held = dict()
+        self.workers = workers
+        self.bank_path = os.path.join(folder, SampleBank.FILENAME) if bank else None
+        self.bank = None
+        self.bank_thread = None
+        self.reducer = reducer
+        if files is None:
+            files = []
+            for filetype in filetypes:
+                files.extend(glob.glob(os.path.join(folder, filetype)))
+            files.sort(key=natural_sort_key)
+        self.files = files
+        self.octaves = 0
+        self.initial_octave = 0
+        self.roots = None
+        self.shifted = collections.OrderedDict()
+        self.shift_queue = collections.deque()
+        self.shifting = set()
+        self.waiting = dict()
+        self.shift_thread = None
+        self.note_cache = note_cache
+        self.shift_lock = threading.Lock()
+        if self.files and pitch_shift:
+            self.roots = sample_notes(self.files, step, first_note)
+            self.octaves = 10
+            self.initial_octave = 5
+        elif self.files:
+            self.octaves = int(len(self.files) / 12)
+            self.initial_octave = int(self.octaves / 2)
+        self.octave = self.initial_octave
+        self.samples = []
+        self.loader = None
+        
+    def note_on(self, channel, octave):
+        """Play the sample for the current key and octave.
+        """
+        if self.roots:
+            return self.note_on_shifted(channel, octave)
+        ind = channel + (octave*12)
+        if ind >= len(self.samples):
+            return ''
+        sample = self.samples[ind]
+        if sample is None:
+            name = os.path.basename(self.files[ind])
+            if ind in self.loader.failed:
+                return 'failed: ' + name
+            return 'loading: {} ({}/{})'.format(name, self.loader.loaded, len(self.files))
+        if PROBE.enabled:
+            PROBE.mark('play')
+        if self.mixer:
+            self.mixer.note_on((channel, octave), self.files[ind], loops=self.loop,
+                               envelope=(0, 0, 1, (self.release_ms or 0) / 1000.0))
+        else:
+            ENGINE.voices.play((channel, octave), sample, self.loop)
+        self.held[channel] = octave
+        return os.path.basename(self.files[ind])
+    
+    def nearest(self, note):
+        """Index of the sample recorded closest to ``note``"""
+        return min(xrange(len(self.roots)), key=lambda i: abs(self.roots[i] - note))
+    
+    def shift(self, note):
+        """The shifted Sound for ``note`` if it is cached, otherwise None"""
+        with self.shift_lock:
+            sound = self.shifted.pop(note, None)
+            if sound is not None:
+                self.shifted[note] = sound
+            return sound
+    
+    def render_shift(self, note):
+        """Resample ``note`` from the nearest sample, and cache it.
+        
+        The sample is read in place, through ``pygame.sndarray.samples``,
+        and only the output frames are interpolated, in one vectorized pass.
+        Returns None while the sample is still loading. Shifted notes are
+        kept in a least recently used cache of ``note_cache`` entries.
+        """
+        ind = self.nearest(note)
+        samples = self.samples
+        sample = samples[ind] if ind < len(samples) else None
+        if sample is None:
+            return None
+        ratio = 2 ** ((note - self.roots[ind]) / 12.0)
+        if ratio == 1.0:
+            sound = sample
+        else:
+            source = pygame.sndarray.samples(sample)
+            index = numpy.arange(max(int((len(source) - 1) / ratio), 1)) * ratio
+            whole = index.astype(numpy.int64)
+            frac = (index - whole).astype(numpy.float32).reshape((-1,) + (1,) * (source.ndim - 1))
+            first = source[whole].astype(numpy.float32)
+            out = first + (source[numpy.minimum(whole + 1, len(source) - 1)] - first) * frac
+            sound = pygame.sndarray.make_sound(numpy.round(out).astype(source.dtype))
+        # deselect can clear self.mixer while this runs
+        mixer = self.mixer
+        if mixer:
+            frames = sound_frames(sound, mixer.format)
+            if self.reducer:
+                frames = self.reducer.fold(frames)
+            mixer.register((self.folder, note), frames)
+        with self.shift_lock:
+            evicted = []
+            if self.samples is samples:
+                self.shifted[note] = sound
+                while len(self.shifted) > self.note_cache:
+                    evicted.append((self.folder, self.shifted.popitem(last=False)[0]))
+            else:
+                # deselected while shifting
+                evicted.append((self.folder, note))
+                sound = None
+        if mixer and evicted:
+            mixer.unregister(evicted)
+        return sound
+    
+    def queue_shift(self, note, first=False):
+        """Have the shift worker resample ``note``, next if ``first``"""
+        with self.shift_lock:
+            if note in self.shifted:
+                return
+            if note in self.shift_queue:
+                if first:
+                    self.shift_queue.remove(note)
+                    self.shift_queue.appendleft(note)
+                return
+            if note in self.shifting:
+                # being resampled now
+                return
+            if first:
+                self.shift_queue.appendleft(note)
+            else:
+                self.shift_queue.append(note)
+            self.shifting.add(note)
+            if not self.shift_thread:
+                self.shift_thread = threading.Thread(target=self.shift_worker,
+                                                     name='WavPlayer-shift')
+                self.shift_thread.daemon = True
+                self.shift_thread.start()
+    
+    def shift_worker(self):
+        """Resample the queued notes, playing the keys waiting for them"""
+        try:
+            while True:
+                with self.shift_lock:
+                    if not self.shift_queue or not self.samples:
+                        self.shift_queue.clear()
+                        self.shifting.clear()
+                        self.shift_thread = None
+                        return
+                    note = self.shift_queue.popleft()
+                try:
+                    sound = self.render_shift(note)
+                except (pygame.error, ValueError, MemoryError) as e:
+                    print("Error: couldn't shift note {}: {}".format(note, e))
+                    sound = None
+                with self.shift_lock:
+                    self.shifting.discard(note)
+                    keys = [key for key, waiting in self.waiting.items() if waiting == note]
+                    for key in keys:
+                        del self.waiting[key]
+                if sound is not None:
+                    for channel, octave in keys:
+                        self.play_shifted(channel, octave, note, sound)
+        finally:
+            with self.shift_lock:
+                if self.shift_thread is threading.current_thread():
+                    self.shift_thread = None
+    
+    def play_shifted(self, channel, octave, note, sound):
+        mixer = self.mixer
+        if mixer:
+            mixer.note_on((channel, octave), (self.folder, note), loops=self.loop,
+                               envelope=(0, 0, 1, (self.release_ms or 0) / 1000.0))
+        else:
+            ENGINE.voices.play((channel, octave), sound, self.loop)
+    
+    def note_on_shifted(self, channel, octave):
+        """Play the key's note, pitch shifted from the nearest sample."""
+        if not self.samples:
+            return ''
+        note = channel + (octave*12)
+        ind = self.nearest(note)
+        name = os.path.basename(self.files[ind])
+        if self.samples[ind] is None:
+            if ind in self.loader.failed:
+                return 'failed: ' + name
+            return 'loading: {} ({}/{})'.format(name, self.loader.loaded, len(self.files))
+        self.held[channel] = octave
+        sound = self.shift(note)
+        if sound is None:
+            with self.shift_lock:
+                self.waiting[(channel, octave)] = note
+            self.queue_shift(note, first=True)
+            return 'shifting: {} {:+d}'.format(name, note - self.roots[ind])
+        if PROBE.enabled:
+            PROBE.mark('play')
+        self.play_shifted(channel, octave, note, sound)
+        return '{} {:+d}'.format(name, note - self.roots[ind])
+    
+    def warm(self, octave):
+        """Queue the notes of ``octave`` for the shift worker, in place of
+        those queued for another octave that no key is waiting for.
+        """
+        with self.shift_lock:
+            wanted = set(self.waiting.values())
+            for note in [n for n in self.shift_queue if n not in wanted]:
+                self.shift_queue.remove(note)
+                self.shifting.discard(note)
+        for channel in xrange(13):
+            self.queue_shift(channel + (octave*12))
+    
+    def note_off(self, channel, octave):
+        """Fade out the key's sample if ``release_ms`` is set.
+        """
+        octave = self.held.pop(channel, octave)
+        if self.roots:
+            with self.shift_lock:
+                if self.waiting.pop((channel, octave), None) is not None:
+                    # released before its note was shifted
+                    return
+        if self.release_ms is None:
+            return
+        if self.mixer:
+            self.mixer.note_off((channel, octave))
+        else:
+            ENGINE.voices.release((channel, octave), self.release_ms)
+    
+    def octave_up(self, octave):
+        """Load the new octave's samples next"""
+        self.change_octave(octave)
+    
+    def octave_down(self, octave):
+        """Load the new octave's samples next"""
+        self.change_octave(octave)
+    
+    def change_octave(self, octave):
+        self.octave = octave
+        if self.roots:
+            if self.loader and self.loader.done():
+                self.warm(octave)
+        elif self.loader:
+            self.loader.prioritize(octave)
+    
+    def loading(self, loader):
+        """SampleLoader progress callback, reports to the console"""
+        if loader.done():
+            post_message('loaded {} {}'.format(len(loader.files), SAMPLE_CACHE))
+            if self.reducer:
+                post_message(str(self.reducer))
+            if self.roots:
+                self.warm(self.octave)
+            if self.bank_path and not self.bank and not loader.failed:
+                self.build_bank(list(loader.samples))
+        elif loader.loaded % 12 == 0:
+            post_message('loaded {}/{}'.format(loader.loaded, len(loader.files)))
+        
+    def build_bank(self, samples):
+        """Write the loaded samples to the folder's SampleBank, on a thread
+        of its own so neither the loader nor a deselect waits for the write.
+        """
+        if self.bank_thread and self.bank_thread.is_alive():
+            return
+        mixer_format = pygame.mixer.get_init()
+        reduced = self.reducer.stats() if self.reducer else None
+        def run():
+            try:
+                SampleBank.build(self.bank_path, self.files, samples, mixer_format, reduced)
+            except (IOError, OSError) as e:
+                print("Error: couldn't write sample bank: {} {}".format(self.bank_path, e))
+            else:
+                post_message('built ' + SampleBank.FILENAME)
+        self.bank_thread = threading.Thread(target=run, name='SampleBank')
+        self.bank_thread.daemon = True
+        self.bank_thread.start()
+    
+    def load(self, path):
+        """Load a sample through the SAMPLE_CACHE, from the bank if open,
+        and register it with the SoftwareMixer if used.
+        """
+        load = self.bank.load if self.bank else (self.decode if self.reducer else None)
+        sample = SAMPLE_CACHE.get(path, load, self.reducer.key if self.reducer else None)
+        if self.mixer and path not in self.mixer.sources:
+            frames = sound_frames(sample, self.mixer.format)
+            if self.reducer:
+                frames = self.reducer.fold(frames)
+            self.mixer.register(path, frames)
+        return sample
+    
+    def decode(self, path):
+        """Decode a sample and trim it with the SampleReducer"""
+        return self.reducer.sound(pygame.mixer.Sound(path), pygame.mixer.get_init(), path)
+        
+    def select(self):
+        """Start the AudioEngine if needed, and start loading the samples.
+        """
+        LEDS.auto_leds(True)
+        mixer_format = ENGINE.start()
+        if self.software:
+            self.mixer = ENGINE.software_mixer()
+        if self.bank_path:
+            self.bank = SampleBank.open(self.bank_path, self.files, mixer_format,
+                                        self.reducer.key if self.reducer else None)
+            if self.bank and self.reducer:
+                self.reducer.restore(self.bank.index['reduced'])
+        self.loader = SampleLoader(self.files, load=self.load,
+                                   progress=self.loading, workers=self.workers)
+        self.samples = self.loader.samples
+        self.octave = self.initial_octave
+        self.loader.start(self.initial_octave)
+        return 'loading {} samples'.format(len(self.files))
+
+    def deselect(self):
+        """Stop the samples playing, the mixer itself stays open.
+        
+        The decoded samples stay in the SAMPLE_CACHE for the next select.
+        """
+        if self.loader:
+            self.loader.cancel()
+            self.loader = None
+        if self.bank:
+            self.bank.close()
+            self.bank = None
+        samples = self.samples
+        self.samples = []
+        with self.shift_lock:
+            shifted = [(self.folder, note) for note in self.shifted]
+            self.shifted.clear()
+            self.shift_queue.clear()
+            self.waiting.clear()
+        if self.mixer:
+            self.mixer.unregister(list(self.files) + shifted)
+            self.mixer = None
+        ENGINE.stop()
+        del samples
+
+def match_channels(frames, channels):
+    """Mix down or duplicate float frames to ``channels``"""
+    if frames.shape[1] == channels:
+        return frames
+    if channels == 1:
+        return frames.mean(axis=1)[:, numpy.newaxis]
+    return numpy.repeat(frames[:, :1], channels, axis=1)
+
+def mixer_array(frames, mixer_format):
+    """Convert float frames between -1.0 and 1.0, shaped (frames,) or
+    (frames, channels), to an array in the mixer format for
+    ``pygame.sndarray.make_sound``.
+    """
+    freq, size, channels = mixer_format
+    if frames.ndim == 1:
+        frames = frames[:, numpy.newaxis]
+    frames = match_channels(frames, channels)
+    bits = abs(size)
+    max_sample = (2 ** (bits - 1)) - 1
+    if size > 0:
+        # unsigned formats are centered on half the range
+        buf = numpy.round((frames + 1) * max_sample).astype(
+            numpy.uint8 if bits == 8 else numpy.uint16)
+    else:
+        buf = numpy.round(frames * max_sample).astype(
+            numpy.int8 if bits == 8 else numpy.int16)
+    return numpy.ascontiguousarray(buf if channels > 1 else buf[:, 0])
+
+def sound_frames(sound, mixer_format):
+    """A pygame Sound as float frames between -1.0 and 1.0"""
+    return mixer_frames(pygame.sndarray.array(sound), mixer_format)
+
+def mixer_frames(array, mixer_format):
+    """An array in the mixer format as float frames between -1.0 and 1.0"""
+    if array.ndim == 1:
+        array = array[:, numpy.newaxis]
+    bits = abs(mixer_format[1])
+    array = array.astype(numpy.float32)
+    if mixer_format[1] > 0:
+        array -= 2 ** (bits - 1)
+    return array / 2 ** (bits - 1)
+
+class WaveDecoder(object):
+    """Read a wav file a block at a time, as float frames between -1.0 and
+    1.0 with the given number of ``channels``.
+    """
+    def __init__(self, path, channels):
+        self.wav = wave.open(path, 'rb')
+        self.rate = self.wav.getframerate()
+        self.width = self.wav.getsampwidth()
+        self.source_channels = self.wav.getnchannels()
+        self.channels = channels
+    
+    def read(self, frames):
+        data = self.wav.readframes(frames)
+        if self.width == 1:
+            # 8 bit wav is unsigned
+            pcm = (numpy.frombuffer(data, numpy.uint8).astype(numpy.float32) - 128) / 128
+        elif self.width == 3:
+            raw = numpy.frombuffer(data, numpy.uint8).reshape(-1, 3).astype(numpy.int32)
+            pcm = ((raw[:, 0] << 8) | (raw[:, 1] << 16) | (raw[:, 2] << 24)).astype(numpy.float32) / 2**31
+        else:
+            dtype = numpy.int16 if self.width == 2 else numpy.int32
+            pcm = numpy.frombuffer(data, dtype).astype(numpy.float32) / 2**(8 * self.width - 1)
+        return match_channels(pcm.reshape(-1, self.source_channels), self.channels)
+    
+    def rewind(self):
+        self.wav.rewind()
+    
+    def close(self):
+        self.wav.close()
+
+class SoundDecoder(object):
+    """Read a compressed track, such as an mp3, a block at a time as float
+    frames, like the WaveDecoder.
+    
+    pygame can only decode these files whole, so the track is decoded to a
+    Sound in the mixer format when opened, on the Streamer thread, and read
+    in place from there.
+    """
+    def __init__(self, path, mixer_format):
+        self.sound = pygame.mixer.Sound(path)
+        self.samples = pygame.sndarray.samples(self.sound)
+        self.format = mixer_format
+        self.rate = mixer_format[0]
+        self.pos = 0
+    
+    def read(self, frames):
+        block = self.samples[self.pos:self.pos + frames]
+        self.pos += len(block)
+        return mixer_frames(block, self.format)
+    
+    def rewind(self):
+        self.pos = 0
+    
+    def close(self):
+        self.samples = self.sound = None
+
+class Resampler(object):
+    """Block by block linear interpolation resampler.
+    
+    ``read(frames)`` supplies source frames, and an empty array at the end.
+    ``ratio`` is the source frames per output frame, and can be changed
+    between blocks; the fractional position and the frames still needed
+    for interpolation carry over to the next block, so there are no clicks.
+    """
+    def __init__(self, read, channels, ratio=1.0):
+        self.read = read
+        self.ratio = ratio
+        self.buffer = numpy.zeros((0, channels), numpy.float32)
+        self.pos = 0.0
+        self.ended = False
+    
+    def block(self, frames):
+        """Up to ``frames`` output frames, fewer at the end of the source"""
+        need = int(self.pos + frames * self.ratio) + 2
+        while len(self.buffer) < need and not self.ended:
+            chunk = self.read(max(need - len(self.buffer), 1024))
+            if len(chunk):
+                self.buffer = numpy.concatenate((self.buffer, chunk))
+            else:
+                self.ended = True
+        index = self.pos + numpy.arange(frames) * self.ratio
+        if self.ended:
+            index = index[index < len(self.buffer) - 1]
+        whole = index.astype(numpy.int64)
+        frac = (index - whole)[:, numpy.newaxis].astype(numpy.float32)
+        out = self.buffer[whole] * (1 - frac) + self.buffer[whole + 1] * frac
+        self.pos += len(index) * self.ratio
+        used = min(int(self.pos), len(self.buffer))
+        self.buffer = self.buffer[used:]
+        self.pos -= used
+        return out
+
+class SongStream(object):
+    """One track streaming to its own mixer channel.
+    
+    The file is decoded and resampled a block at a time by the Streamer
+    thread, each block queued on the channel behind the one playing.
+    ``speed`` changes take effect from the next block. Wav files are read
+    by a WaveDecoder, anything else by a SoundDecoder, and where pygame
+    can't decode that it plays as a MusicStream instead.
+    
+    ``halt`` silences the stream from any thread, the decoder is closed
+    by ``close`` on the Streamer thread.
+    """
+    def __init__(self, path, channel, speed=1.0, loops=0):
+        self.path = path
+        self.channel = channel
+        self.speed = speed
+        self.loops = loops
+        self.decoder = None
+        self.resampler = None
+        self.music = None
+        self.finished = False
+    
+    def open(self, mixer_format):
+        channels = mixer_format[2]
+        if self.path.lower().endswith('.wav'):
+            self.decoder = WaveDecoder(self.path, channels)
+        else:
+            try:
+                self.decoder = SoundDecoder(self.path, mixer_format)
+            except pygame.error:
+                post_message("can't decode {}, playing it at normal speed".format(
+                    os.path.basename(self.path)))
+                self.music = MusicStream(self.path, self.loops)
+                return
+        self.rate = float(self.decoder.rate) / mixer_format[0]
+        self.resampler = Resampler(self.read, channels, self.rate * self.speed)
+    
+    def read(self, frames):
+        block = self.decoder.read(frames)
+        if not len(block) and self.loops != 0:
+            self.loops -= 1
+            self.decoder.rewind()
+            block = self.decoder.read(frames)
+        return block
+    
+    def feed(self, frames, mixer_format):
+        """Queue the next block if the channel is ready for it"""
+        if self.finished:
+            return
+        if self.decoder is None and self.music is None:
+            self.open(mixer_format)
+        if self.music:
+            self.music.feed(frames, mixer_format)
+            self.finished = self.music.finished
+            return
+        if self.channel.get_busy() and self.channel.get_queue() is not None:
+            return
+        self.resampler.ratio = self.rate * self.speed
+        block = self.resampler.block(frames)
+        if not len(block):
+            self.finished = not self.channel.get_busy()
+            return
+        sound = pygame.sndarray.make_sound(mixer_array(block, mixer_format))
+        if self.channel.get_busy():
+            self.channel.queue(sound)
+        else:
+            self.channel.play(sound)
+    
+    def halt(self):
+        self.finished = True
+        self.channel.stop()
+        if self.music:
+            self.music.halt()
+    
+    def close(self):
+        self.finished = True
+        self.channel.stop()
+        if self.music:
+            self.music.close()
+        if self.decoder:
+            self.decoder.close()
+            self.decoder = None
+
+class MusicStream(object):
+    """A compressed track, such as an mp3, played by pygame.mixer.music.
+    
+    Older versions of pygame can't decode these files into a Sound, while
+    pygame.mixer.music decodes as it plays. There is just the one music
+    stream, so starting another song ends the one playing, and the song
+    always plays at normal speed.
+    """
+    current = None
+    
+    def __init__(self, path, loops=0):
+        self.path = path
+        self.loops = loops
+        self.speed = 1.0
+        self.started = False
+        self.finished = False
+    
+    def feed(self, frames, mixer_format):
+        """Start the song, and notice when it ends or is replaced"""
+        if self.finished:
+            return
+        if not self.started:
+            self.started = True
+            MusicStream.current = self
+            pygame.mixer.music.load(self.path)
+            pygame.mixer.music.play(self.loops)
+        elif MusicStream.current is not self or not pygame.mixer.music.get_busy():
+            self.finished = True
+    
+    def halt(self):
+        self.finished = True
+        if MusicStream.current is self:
+            pygame.mixer.music.stop()
+    
+    def close(self):
+        self.finished = True
+        if MusicStream.current is self:
+            MusicStream.current = None
+            pygame.mixer.music.stop()
+
+class Streamer(object):
+    """Background thread keeping each SongStream's channel fed.
+    
+    The thread runs only while there are streams, waking every ``interval``
+    seconds, well inside the ``block`` frames each queued Sound lasts.
+    Streams stopped from other threads are halted at once and closed on
+    the thread, so a stream is never closed while it is being fed. An error
+    in one stream ends only that stream.
+    """
+    def __init__(self, block=4096, interval=0.02):
+        self.block = block
+        self.interval = interval
+        self.streams = dict()
+        self.closing = []
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = None
+    
+    def start(self):
+        """Start the thread if it is not running, call with the lock held"""
+        if not self.thread:
+            self.thread = threading.Thread(target=self.run, name='Streamer')
+            self.thread.daemon = True
+            self.thread.start()
+    
+    def play(self, key, stream):
+        with self.lock:
+            old = self.streams.pop(key, None)
+            self.streams[key] = stream
+            if old:
+                self.closing.append(old)
+            self.start()
+        if old:
+            old.halt()
+        self.wake.set()
+    
+    def stop(self, key):
+        with self.lock:
+            stream = self.streams.pop(key, None)
+            if stream:
+                self.closing.append(stream)
+                self.start()
+        if stream:
+            stream.halt()
+            self.wake.set()
+    
+    def stop_all(self):
+        with self.lock:
+            streams = list(self.streams.values())
+            self.streams.clear()
+            self.closing.extend(streams)
+            if streams:
+                self.start()
+        for stream in streams:
+            stream.halt()
+        self.wake.set()
+    
+    def set_speed(self, speed):
+        with self.lock:
+            for stream in self.streams.values():
+                stream.speed = speed
+    
+    def close(self, stream):
+        try:
+            stream.close()
+        except Exception as e:
+            print("Error: couldn't close stream: {} {}".format(stream.path, e))
+    
+    def run(self):
+        try:
+            while True:
+                self.wake.wait(self.interval)
+                self.wake.clear()
+                mixer_format = pygame.mixer.get_init()
+                with self.lock:
+                    closing = self.closing
+                    self.closing = []
+                    streams = list(self.streams.items())
+                for stream in closing:
+                    self.close(stream)
+                with self.lock:
+                    if not mixer_format or not (self.streams or self.closing):
+                        self.thread = None
+                        return
+                for key, stream in streams:
+                    try:
+                        stream.feed(self.block, mixer_format)
+                    except Exception as e:
+                        print("Error: couldn't stream: {} {}".format(stream.path, e))
+                        stream.finished = True
+                    if stream.finished:
+                        with self.lock:
+                            if self.streams.get(key) is stream:
+                                del self.streams[key]
+                                self.closing.append(stream)
+        finally:
+            with self.lock:
+                if self.thread is threading.current_thread():
+                    self.thread = None
+
+class Songs(WavPlayer):
+    """Example sound board style music player for playing longer mp3 tracks.
+    When holding down the specific key. Multiple songs can be mixed at once.
+    
+    Songs are mapped the same way they are with the WavPlayer.
+    
+    Each key streams its song to its own mixer channel through a Streamer,
+    so songs are held and released independently.
+    
+    Octaves modify the song speed from 0 to 10, with 4 being normal speed,
+    by resampling the stream a block at a time.
+    """
+    def __init__(self, folder, filetypes=('*.mp3',), loop=0, files=None):
+        WavPlayer.__init__(self, folder, filetypes, loop, bank=False, files=files)
         self.name="Songs:"+os.path.basename(folder)
         self.octaves = 10
         self.initial_octave = 4
-        self.last_octave = 4
+        self.speed = 1.0
+        self.streamer = Streamer()
         
     def select(self):
-        """Initialize the pygame mixer for mp3 playback.
+        """Start the AudioEngine if needed, and reserve a mixer channel
+        for each key.
         """
-        if pianohat:
-            pianohat.auto_leds(True)
-        pygame.mixer.pre_init(4411*(self.initial_octave+1), -16, 2, 2048)
-        pygame.mixer.init()
+        LEDS.auto_leds(True)
+        ENGINE.start()
+        ENGINE.reserve(13)
+        self.speed = 1.0
+    
+    def deselect(self):
+        self.streamer.stop_all()
+        ENGINE.reserve(0)
     
     def note_on(self, channel, octave):
-        """Load and play the mp3 file.
-        Optionally re-initialize the pygame mixer if the octave is different
-        from the current initialization.
+        """Start streaming the song on the key's channel.
         """
         ind = channel
         if ind >= len(self.files):
             return ''
-        if octave != self.last_octave:
-            pygame.mixer.music.stop()
-            pygame.mixer.stop()
-            pygame.mixer.quit()
-            pygame.mixer.pre_init(4411*(octave+1), -16, 1, 512)
-            self.last_octave = octave
-            pygame.mixer.init()
-            pygame.mixer.set_num_channels(32)
-        pygame.mixer.music.load(self.files[ind])
-        x = pygame.mixer.music.play(self.loop)
+        if PROBE.enabled:
+            PROBE.mark('play')
+        stream = SongStream(self.files[ind], pygame.mixer.Channel(channel), self.speed, self.loop)
+        self.streamer.play(channel, stream)
         return os.path.basename(self.files[ind])
     
     def note_off(self, channel, octave):
-        """Stop playing the mp3 when the key is no longer pressed.
+        """Stop playing the song when the key is no longer pressed.
         """
-        # NOTE: This stops all music from playing.
-        #       need to figure out how to stop each individually.
-        pygame.mixer.music.stop()
+        self.streamer.stop(channel)
+    
+    def set_speed(self, octave):
+        self.speed = (octave + 1.0) / (self.initial_octave + 1)
+        self.streamer.set_speed(self.speed)
+        return 'speed x{:.1f}'.format(self.speed)
+    
+    def octave_up(self, octave):
+        """Speed up the songs playing and played next"""
+        return self.set_speed(octave)
+    
+    def octave_down(self, octave):
+        """Slow down the songs playing and played next"""
+        return self.set_speed(octave)
+
 
+def note_frequency(note):
+    """Frequency in Hz of a midi note number, where 69 is A4 (440Hz)
+    """
+    return 440.0 * 2 ** ((note - 69) / 12.0)
+
+class Wavetable(object):
+    """Cache of looping waveforms rendered with numpy on demand.
+    
+    Each waveform is rendered as a whole number of cycles, long enough that
+    the pitch error from rounding to whole samples is negligible even in the
+    top octaves, in one vectorized pass. Tables are only rendered the first
+    time a note is asked for, and kept for the life of the Wavetable.
+    
+    ``bits`` is the resolution of the generated wave (8 or 16), ``samplerate``,
+    ``size`` and ``channels`` are the pygame mixer format as returned
+    by ``pygame.mixer.get_init()``.
+    """
+    WAVETYPES = ('sine', 'saw', 'square')
+    MIN_SAMPLES = 1024
+    
+    def __init__(self, samplerate=44100, size=-16, channels=2, bits=8):
+        if bits not in (8, 16):
+            raise ValueError("Wavetable bits must be 8 or 16, not {}".format(bits))
+        self.samplerate = samplerate
+        self.size = size
+        self.channels = channels
+        self.bits = bits
+        self.tables = dict()
+        self.sounds = dict()
+    
+    def format(self):
+        return (self.samplerate, self.size, self.channels)
+    
+    def phase(self, frequency):
+        """Phase (0.0-1.0) of each sample over a whole number of cycles"""
+        cycles = max(1, int(round(self.MIN_SAMPLES * frequency / self.samplerate)))
+        sample_count = max(2, int(round(cycles * self.samplerate / frequency)))
+        return (numpy.arange(sample_count) * (float(cycles) / sample_count)) % 1.0
+    
+    def render(self, wavetype, frequency):
+        """Render the wave as floats between -1.0 and 1.0, quantized to ``bits``"""
+        phase = self.phase(frequency)
+        if wavetype == 'sine':
+            wave = numpy.sin(2 * numpy.pi * phase)
+        elif wavetype == 'saw':
+            wave = (phase * 2) - 1
+        elif wavetype == 'square':
+            wave = numpy.where(phase < 0.5, -0.9, 0.9)
+        else:
+            raise ValueError("Unknown wavetype: {}".format(wavetype))
+        max_sample = (2 ** (self.bits - 1)) - 1
+        return numpy.round(wave * max_sample) / max_sample
+    
+    def table(self, wavetype, note):
+        """The rendered wave in the mixer format, for a midi note number"""
+        key = (wavetype, note)
+        buf = self.tables.get(key)
+        if buf is None:
+            wave = self.render(wavetype, note_frequency(note))
+            buf = mixer_array(wave, self.format())
+            self.tables[key] = buf
+        return buf
+    
+    def sound(self, wavetype, note, volume=1.0):
+        """A pygame Sound for the note, built from the table on first use"""
+        key = (wavetype, note)
+        sound = self.sounds.get(key)
+        if sound is None:
+            sound = pygame.sndarray.make_sound(self.table(wavetype, note))
+            sound.set_volume(volume) # Set the volume to balance sounds
+            self.sounds[key] = sound
+        return sound
+
+class LazyInstrument(Instrument):
+    """Stands in for an instrument until it is first selected, when
+    PiPianoUI replaces it with the instrument ``factory`` builds.
+    """
+    def __init__(self, name, factory):
+        Instrument.__init__(self, name)
+        self.factory = factory
+    
+    def build(self):
+        return self.factory()
 
 class Synth8Bit(Instrument):
     """Example 8-bit synthesizer
@@ -526,83 +3189,35 @@ class Synth8Bit(Instrument):
     Based on code from:
     https://github.com/pimoroni/Piano-HAT/blob/master/examples/8bit-synth.py
     
-    The sine is still off and this needs more work.
+    Notes cover the full octave range, with the octave keys moving between
+    octaves. The top C key cycles through the combinations of sine, square
+    and saw waves, shown on LEDs C2 (sine), octave down (square) and octave
+    up (saw).
+    
+    Waves are rendered by a Wavetable when a note is first played, in the
+    AudioEngine format. ``bitrate`` is the resolution of the waves, 8 or 16
+    bit, whatever the mixer format.
+    
+    With ``software`` the waves are played by the engine's SoftwareMixer,
+    with sample accurate attack and release.
     """
-    def __init__(self):
+    def __init__(self, octaves=10, initial_octave=5, bitrate=8, software=False):
         self.name = "8BitSynth"
-        self.octaves=0
-        self.initial_octave=0
+        self.octaves = octaves
+        self.initial_octave = initial_octave
         self.enabled = FlipFlopState()
         self.t2c = dict(sine=12, square=13, saw=14)
         
-        self.BITRATE = 8
-        self.SAMPLERATE = 44100
+        self.BITRATE = bitrate
         self.ATTACK_MS=25
         self.RELEASE_MS=500
         
-        self.stereo = True # need to ask pygame if it is stereo device (not just what we set)
         self.volume = {'sine':.15, 'saw':0.15, 'square':1.0}
         self.wavetypes = ['sine','saw','square']
-        self.notes = {'sine':[],'saw':[],'square':[]}
-        
-        max_sample = (2**(self.BITRATE - 1)) - 1
-        
-        def wave_sine(freq, time):
-            """Generates a single sine wave sample"""
-            s = numpy.sin(2*numpy.pi*freq*time)
-            return int(round(max_sample * s ))
-        
-        
-        def wave_square(freq, time):
-            """Generates a single square wave sample"""
-            m = int(max_sample * 0.9)
-            return -m if freq*time < 0.5 else m
-        
-        
-        def wave_saw(freq, time):
-            """Generates a single sav wave sample"""
-            s = ((freq*time)*2) - 1
-            return int(round(max_sample * s))
-        
-        def generate_sample(frequency, volume=1.0, wavetype=None, stereo=True):
-            """Generates a sample of a specific frequency and wavetype"""
-            if wavetype is None:
-                wavetype = wave_square
-        
-            sample_count = int(round(self.SAMPLERATE/frequency))
-        
-            buf = numpy.array([wavetype(frequency, float(x)/self.SAMPLERATE)
-                               for x in range(sample_count)]).astype(numpy.int8)
-            if stereo:
-                stbuf = numpy.zeros((sample_count, 2), dtype = numpy.int8)
-                for i, b in enumerate(buf):
-                    stbuf[i,0] = b
-                    stbuf[i,1] = b
-                buf = stbuf
-            sound = pygame.sndarray.make_sound(buf)
-        
-            sound.set_volume(volume) # Set the volume to balance sounds
-            return sound
-        
-        for f in [261.626,
-                  277.183,
-                  293.665,
-                  311.127,
-                  329.628,
-                  349.228,
-                  369.994,
-                  391.995,
-                  415.305,
-                  440.000,
-                  466.164,
-                  493.883,
-                  523.251]:
-            self.notes['sine'] += [generate_sample(f, volume=self.volume['sine'],
-                                                   wavetype=wave_sine)]
-            self.notes['saw'] += [generate_sample(f, volume=self.volume['saw'],
-                                                  wavetype=wave_saw)]
-            self.notes['square'] += [generate_sample(f, volume=self.volume['square'],
-                                                     wavetype=wave_square)]
+        self.wavetable = None
+        self.software = software
+        self.mixer = None
+        self.playing = dict()
         
     def toggle(self, t):
         """Toggle the on off state of the sine,square, or saw
@@ -610,67 +3225,221 @@ class Synth8Bit(Instrument):
         self.t2c[t]
         en = self.enabled.toggle(t)
         ns = ' on' if en else ' off'
-        if pianohat:
-            pianohat.set_led(self.t2c[t], en)
+        LEDS.set(self.t2c[t], en)
         return t + ns
     
-    def octave_up(self, octave):
-        """Toggle saw"""
-        return self.toggle('saw')
-    
-    def octave_down(self, octave):
-        """Toggle square"""
-        return self.toggle('square')
+    def cycle(self):
+        """Step to the next combination of enabled waves, treating sine,
+        square and saw as the bits of a counter that skips all off.
+        """
+        order = ['sine', 'square', 'saw']
+        for t in order:
+            self.toggle(t)
+            if self.enabled[t]:
+                break
+        if not any(self.enabled[t] for t in order):
+            self.toggle('sine')
+        return '+'.join(t for t in order if self.enabled[t])
     
     def select(self):
-        if pianohat:
-            pianohat.auto_leds(False)
-            for i in xrange(16):
-                pianohat.set_led(i, False)
+        LEDS.auto_leds(False)
+        LEDS.clear()
         self.enabled = FlipFlopState()
-        pygame.mixer.pre_init(self.SAMPLERATE, -self.BITRATE, 1, 1024)
-        pygame.mixer.init(channels=1)
-        #pygame.mixer.set_num_channels(32)
+        mixer_format = ENGINE.start()
+        if not self.wavetable or self.wavetable.format() != mixer_format:
+            self.wavetable = Wavetable(*mixer_format, bits=self.BITRATE)
+        if self.software:
+            self.mixer = ENGINE.software_mixer()
         self.toggle('sine') # by default enable sine.
-        return "C2=sine,v=square,^saw"
+        return "C2=sine/square/saw v^=octave"
     
     def deselect(self):
-        if pianohat:
-            for i in xrange(16):
-                pianohat.set_led(i, False)
-            pianohat.auto_leds(True)
+        LEDS.clear()
+        LEDS.auto_leds(True)
         self.enabled = FlipFlopState()
-        pygame.mixer.stop()
-        pygame.mixer.quit()
+        self.playing = dict()
+        if self.mixer:
+            self.mixer.unregister([k for k in self.mixer.sources if k[0] == 'synth'])
+            self.mixer = None
+        ENGINE.stop()
 
     def note_on(self, channel, octave):
         """Generate the soundwave
         """
         if channel == 12:
-            return self.toggle('sine')
-        if pianohat:
-            pianohat.set_led(channel, True)
+            return self.cycle()
+        LEDS.set(channel, True)
         note_name = key_name(channel)
+        note = (octave * 12) + channel
+        if PROBE.enabled:
+            PROBE.mark('play')
+        first = True
         for t in self.wavetypes:
             if self.enabled[t]:
                 note_name += ' ' + t
-                self.notes[t][channel].play(-1, fade_ms=self.ATTACK_MS)
-        return note_name
+                if self.mixer:
+                    self.play_software((channel, octave), t, note)
+                    continue
+                sound = self.wavetable.sound(t, note, self.volume[t])
+                ENGINE.voices.play((channel, octave), sound, -1, fade_ms=self.ATTACK_MS,
+                                   retrigger=first)
+                first = False
+        self.playing[channel] = octave
+        return note_name + ' ' + str(octave)
                 
     def note_off(self, channel, octave):
         """Fade the key's soundwave to nothing
         """
         if channel == 12:
             return
-        if pianohat:
-            pianohat.set_led(channel, False)
-        for t in self.wavetypes:
-            self.notes[t][channel].fadeout(self.RELEASE_MS)
+        LEDS.set(channel, False)
+        if channel not in self.playing:
+            return
+        key = (channel, self.playing.pop(channel))
+        if self.mixer:
+            self.mixer.note_off(key)
+        else:
+            ENGINE.voices.release(key, self.RELEASE_MS)
+    
+    def play_software(self, key, wavetype, note):
+        """Play a wave on the SoftwareMixer, registering it on first use"""
+        source = ('synth', self.BITRATE, wavetype, note)
+        if source not in self.mixer.sources:
+            self.mixer.register(source, self.wavetable.render(wavetype, note_frequency(note)))
+        self.mixer.note_on(key, source, gain=self.volume[wavetype], loops=-1,
+                           envelope=(self.ATTACK_MS / 1000.0, 0, 1, self.RELEASE_MS / 1000.0))
 
 
 
 
+class MidiWriter(object):
+    """Background thread writing MIDI events to a sequencer.
+    
+    ``write`` only appends to a bounded deque, which needs no lock, so a
+    slow sequencer client never stalls key handling. The thread takes
+    every event waiting, chords pressed together arrive as one batch, and
+    writes them stamped with the same tick on the sequencer queue, draining
+    the sequencer's output once for the batch. Note on events are dropped,
+    and counted, when ``maxlen`` are already waiting; everything else, like
+    the note offs, is always queued, and still written when an event
+    before it in the batch fails, so no note is left stuck on.
+    """
+    # the ALSA binding is shared by every writer, see flush
+    output_lock = threading.Lock()
+    
+    def __init__(self, seq, maxlen=256):
+        self.seq = seq
+        self.maxlen = maxlen
+        self.events = collections.deque()
+        self.wake = threading.Event()
+        self.running = False
+        self.thread = None
+        self.latency = Histogram()
+        self.written = 0
+        self.batches = 0
+        self.dropped = 0
+        self.max_depth = 0
+    
+    def write(self, event):
+        """Queue ``event`` for the writer thread, False if it was dropped"""
+        depth = len(self.events)
+        if depth >= self.maxlen and self.droppable(event):
+            self.dropped += 1
+            return False
+        self.events.append((_clock(), event))
+        self.max_depth = max(self.max_depth, depth + 1)
+        self.wake.set()
+        return True
+    
+    @staticmethod
+    def droppable(event):
+        """Only note ons may be dropped, a velocity 0 note on is a note off"""
+        return isinstance(event, midi.NoteOnEvent) and event.velocity > 0
+    
+    def start(self):
+        if not self.running:
+            self.running = True
+            self.thread = threading.Thread(target=self.run, name='MidiWriter')
+            self.thread.daemon = True
+            self.thread.start()
+    
+    def stop(self):
+        """Stop the thread once the waiting events are written"""
+        self.running = False
+        self.wake.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+    
+    def run(self):
+        while self.running or self.events:
+            self.wake.wait()
+            self.wake.clear()
+            batch = []
+            while self.events:
+                batch.append(self.events.popleft())
+            if batch:
+                self.flush(batch)
+    
+    def flush(self, batch):
+        """Write ``batch`` and drain the output once.
+        
+        python-midi's ``event_write`` drains the output after every event,
+        so the binding's drain is held back while the batch is written.
+        """
+        errors = []
+        written = []
+        with self.output_lock:
+            alsa = getattr(midi.sequencer, 'S', None)
+            drain = getattr(alsa, 'snd_seq_drain_output', None)
+            if drain:
+                alsa.snd_seq_drain_output = lambda client: 0
+            try:
+                try:
+                    tick = self.seq.queue_get_tick_time()
+                except RuntimeError as e:
+                    errors.append(e)
+                    tick = 0
+                for queued, event in batch:
+                    event.tick = tick
+                    try:
+                        self.seq.event_write(event, False, False, True)
+                    except RuntimeError as e:
+                        errors.append(e)
+                    else:
+                        written.append(queued)
+            finally:
+                if drain:
+                    alsa.snd_seq_drain_output = drain
+                    if drain(self.seq.client) < 0:
+                        errors.append('drain failed')
+        now = _clock()
+        for queued in written:
+            self.latency.add(now - queued)
+        if errors:
+            print("Error: couldn't write {} of {} MIDI events: {}".format(
+                len(batch) - len(written), len(batch), errors[-1]))
+        self.written += len(written)
+        self.batches += 1
+    
+    def depth(self):
+        return len(self.events)
+    
+    def stats(self):
+        return dict(written=self.written, batches=self.batches, dropped=self.dropped,
+                    depth=self.depth(), max_depth=self.max_depth,
+                    latency=self.latency.summary())
+    
+    def __str__(self):
+        latency = self.latency.summary()
+        return 'midi {} events in {} batches, depth max {} dropped {}, p99 {:.2f}ms max {:.2f}ms'.format(
+            self.written, self.batches, self.max_depth, self.dropped,
+            latency['p99'] * 1000, latency['max'] * 1000)
+
 class Midi(Instrument):
+    """Plays notes on a MIDI sequencer client, such as yoshimi or a USB
+    MIDI adapter. Events are written by a MidiWriter thread.
+    """
     def __init__(self, client, name="", octaves=10, initial_octave=5,
                  port=0, patch=1, banks=16, velocity=100):
         self.client = client
@@ -683,35 +3452,273 @@ class Midi(Instrument):
         self.velocity = velocity
         
         self.seq = None
+        self.writer = None
         
     def select_patch(self, patch):
         if patch < 0 or patch >= self.banks:
             return
         self.patch = patch
-        self.seq.event_write(midi.ProgramChangeEvent(tick=0, channel=0, data=[patch]), False, False, True)
+        self.writer.write(midi.ProgramChangeEvent(tick=0, channel=0, data=[patch]))
     
     def note_on(self, channel, octave):
         note = (octave * 12)  + channel
-        self.seq.event_write(midi.NoteOnEvent(velocity=self.velocity, pitch=note, tick=0), False, False, True)
+        if PROBE.enabled:
+            PROBE.mark('play')
+        self.writer.write(midi.NoteOnEvent(velocity=self.velocity, pitch=note, tick=0))
         return "on {}".format(note)
     
     def note_off(self, channel, octave):
         note = (octave * 12)  + channel
-        self.seq.event_write(midi.NoteOffEvent(velocity=100, pitch=note, tick=0), False, False, True)
+        self.writer.write(midi.NoteOffEvent(velocity=100, pitch=note, tick=0))
         return "off {}".format(note)
     
+    def open_sequencer(self):
+        seq = midi.sequencer.SequencerWrite()
+        seq.subscribe_port(self.client, self.port)
+        seq.start_sequencer()
+        return seq
+    
     def select(self):
-        self.seq = midi.sequencer.SequencerWrite()
-        self.seq.subscribe_port(self.client, self.port)
-        self.seq.start_sequencer()
+        self.seq = self.open_sequencer()
+        self.writer = MidiWriter(self.seq)
+        self.writer.start()
         self.select_patch(self.patch)
         
     def deselect(self):
+        # let the note offs already queued reach the sequencer
+        self.writer.stop()
+        post_message(str(self.writer))
         seq = self.seq
         self.seq.stop_sequencer()
         self.seq = None
         del seq
 
+class MidiFilePlayer(object):
+    """Plays a Standard MIDI File through the current instrument of a
+    PiPianoUI, with the on screen keys and Piano-HAT LEDs following.
+    
+    The whole file is converted to seconds, following its tempo changes,
+    and handed to the Scheduler against one start time. The notes are
+    played by PiPianoUI ``play_note`` on the Scheduler thread, those outside
+    the instrument's octaves are skipped.
+    """
+    def __init__(self, phat, scheduler=SCHEDULER, lead=0.1):
+        self.phat = phat
+        self.scheduler = scheduler
+        self.lead = lead
+        self.held = set()
+        self.path = None
+        self.skipped = 0
+    
+    @staticmethod
+    def notes(path):
+        """(seconds, pitch, on) for each note in the file, in order"""
+        pattern = midi.read_midifile(path)
+        pattern.make_ticks_abs()
+        events = sorted((e.tick, i, e) for track in pattern for i, e in enumerate(track))
+        tempo = 500000.0 # microseconds per beat
+        seconds = 0.0
+        last = 0
+        notes = []
+        for tick, i, event in events:
+            seconds += (tick - last) * tempo / 1000000.0 / pattern.resolution
+            last = tick
+            if isinstance(event, midi.SetTempoEvent):
+                tempo = event.mpqn
+            elif isinstance(event, midi.NoteOnEvent):
+                notes.append((seconds, event.pitch, event.velocity > 0))
+            elif isinstance(event, midi.NoteOffEvent):
+                notes.append((seconds, event.pitch, False))
+        return notes
+    
+    def play(self, path):
+        """Start playing ``path``, returns the number of notes"""
+        self.stop()
+        try:
+            notes = self.notes(path)
+        except (IOError, OSError, TypeError, ValueError) as e:
+            print("Error: couldn't read MIDI file: {} {}".format(path, e))
+            return 0
+        self.path = path
+        self.skipped = 0
+        start = _clock() + self.lead
+        for seconds, pitch, on in notes:
+            self.scheduler.at(start + seconds, self.note, (pitch, on), self)
+        end = start + (notes[-1][0] if notes else 0)
+        self.scheduler.at(end, self.finished, (), self)
+        return len(notes)
+    
+    def playing(self):
+        return self.scheduler.pending(self) > 0
+    
+    def note(self, pitch, on):
+        octave, channel = divmod(pitch, 12)
+        if octave >= self.phat.octaves:
+            self.skipped += 1
+            return
+        if on:
+            self.held.add((channel, octave))
+        else:
+            self.held.discard((channel, octave))
+        self.phat.play_note(channel, on, octave)
+        LEDS.set(channel, on)
+    
+    def stop(self):
+        """Stop playing and release the notes still held"""
+        self.scheduler.cancel(self)
+        for channel, octave in list(self.held):
+            self.note(octave * 12 + channel, False)
+    
+    def finished(self):
+        post_message('played {}, {} skipped'.format(os.path.basename(self.path), self.skipped))
+        post_message(str(self.scheduler))
+
+class Looper(object):
+    """Live looper, records the keys played for ``bars`` bars and plays
+    them back round and round through the current instrument, while
+    playing along on top.
+    
+    Every note and metronome click is scheduled on the Scheduler at an
+    absolute time from the loop's start, a cycle ahead, and played on the
+    Scheduler thread, so a slow frame never delays them and a late note
+    never shifts the ones after it. The Scheduler's jitter and late counts
+    are in ``stats``.
+    
+    ``click`` is a sample played on every beat by the metronome, louder
+    on the first beat of the bar.
+    """
+    def __init__(self, phat, scheduler=SCHEDULER, bpm=120, bars=2, beats=4, click=None):
+        self.phat = phat
+        self.scheduler = scheduler
+        self.bpm = bpm
+        self.bars = bars
+        self.beats = beats
+        self.click = click
+        self.sounds = None
+        self.metronome = False
+        self.recording = False
+        self.playing = False
+        self.origin = None
+        self.notes = []
+        self.held = set()
+        self.cycles = 0
+        self.clicks = 0
+    
+    def beat(self):
+        return 60.0 / self.bpm
+    
+    def length(self):
+        return self.bars * self.beats * self.beat()
+    
+    def toggle(self):
+        """Start recording, or start playing what was recorded, or stop"""
+        if self.playing or self.recording:
+            self.stop()
+            return 'loop stopped, ' + str(self.scheduler)
+        self.notes = []
+        self.origin = self.next_beat()
+        self.recording = True
+        self.scheduler.at(self.origin + self.length(), self.play, (), self)
+        if not self.metronome:
+            self.start_metronome()
+        return 'recording {} bars at {} bpm'.format(self.bars, self.bpm)
+    
+    def next_beat(self):
+        """The time of the next metronome beat, or now if it isn't running"""
+        now = _clock()
+        if self.origin is None or not self.metronome:
+            return now
+        beats = math.ceil((now - self.origin) / self.beat())
+        return self.origin + beats * self.beat()
+    
+    def capture(self, channel, octave, pressed, timestamp=None):
+        """Record a key played live while recording"""
+        offset = (timestamp or _clock()) - self.origin
+        if offset >= 0 and (offset < self.length() or not pressed):
+            self.notes.append((offset, channel, octave, pressed))
+    
+    def play(self):
+        """End of recording, start playing the loop back"""
+        self.recording = False
+        if not self.notes:
+            post_message('nothing recorded')
+            return
+        # release keys still held at the end, before they play again
+        held = set()
+        for offset, channel, octave, pressed in self.notes:
+            (held.add if pressed else held.discard)((channel, octave))
+        for channel, octave in held:
+            self.notes.append((self.length() - 0.001, channel, octave, False))
+        self.playing = True
+        self.cycles = 0
+        self.cycle(1)
+        post_message('looping {} notes'.format(len(self.notes)))
+    
+    def cycle(self, n):
+        """Schedule cycle ``n`` of the loop, and this again for the next"""
+        start = self.origin + n * self.length()
+        for offset, channel, octave, pressed in self.notes:
+            self.scheduler.at(start + offset, self.note, (channel, octave, pressed), self)
+        self.scheduler.at(start, self.cycle, (n + 1,), self)
+        self.cycles += 1
+    
+    def note(self, channel, octave, pressed):
+        if pressed:
+            self.held.add((channel, octave))
+        else:
+            self.held.discard((channel, octave))
+        self.phat.play_note(channel, pressed, octave)
+    
+    def start_metronome(self):
+        if not self.click:
+            return
+        if not self.sounds:
+            # a quieter copy for the off beats, channel volumes are shared
+            sound = SAMPLE_CACHE.get(self.click)
+            array = pygame.sndarray.array(sound)
+            self.sounds = (sound, pygame.sndarray.make_sound((array // 2).astype(array.dtype)))
+        now = _clock()
+        if self.origin is None:
+            self.origin = now
+        self.metronome = True
+        # start on the downbeat at the origin if it has only just passed
+        beats = math.ceil(max(now - self.origin - self.scheduler.late, 0) / self.beat())
+        self.scheduler.at(self.origin + beats * self.beat(), self.tick, (), self)
+    
+    def tick(self):
+        if not self.metronome:
+            return
+        now = _clock()
+        beat = int(round((now - self.origin) / self.beat()))
+        ENGINE.voices.play(('click',), self.sounds[0 if beat % self.beats == 0 else 1])
+        self.clicks += 1
+        self.scheduler.at(self.origin + (beat + 1) * self.beat(), self.tick, (), self)
+    
+    def toggle_metronome(self):
+        if self.metronome:
+            self.metronome = False
+            if not self.playing and not self.recording:
+                self.scheduler.cancel(self)
+                self.origin = None
+            return 'metronome off'
+        if not self.click:
+            return 'no metronome click sample'
+        self.start_metronome()
+        return 'metronome {} bpm'.format(self.bpm)
+    
+    def stop(self):
+        """Stop recording or playing the loop, and the metronome"""
+        self.scheduler.cancel(self)
+        self.recording = self.playing = self.metronome = False
+        self.origin = None
+        for channel, octave in list(self.held):
+            self.note(channel, octave, False)
+    
+    def stats(self):
+        stats = self.scheduler.stats()
+        stats.update(cycles=self.cycles, clicks=self.clicks, notes=len(self.notes))
+        return stats
+
 _MIDI_IGNORE = [
     '__sequencer__',
     'System',
@@ -722,36 +3729,272 @@ _MIDI_SUPPORTED = [
     'SunVox',
     'CH345'
 ]
+_ASOUND_CLIENTS = '/proc/asound/seq/clients'
+
+def midi_clients(load_unknown=True):
+    """The usable midi hardware as a dict of name to client number,
+    excluding known incompatable sequencers.
+    """
+    clients = dict()
+    hw = midi.sequencer.SequencerHardware()
+    for name in hw._clients:
+        if name in _MIDI_IGNORE:
+            continue
+        if name not in _MIDI_SUPPORTED and not load_unknown:
+            continue
+        clients[name] = hw._clients[name].client
+    return clients
+
 def load_midi_sequencers(phat, load_unknown=True):
     """Iterate over the available midi hardware, excluding known
     incompatable sequencers, and loadking known good ones.
     """
     if not midi:
         return
-    hw = midi.sequencer.SequencerHardware()
-    for name in hw._clients:
-        if name in _MIDI_IGNORE:
-            continue
+    for name, client in midi_clients(load_unknown).items():
         if name not in _MIDI_SUPPORTED:
-            if not load_unknown:
-                continue
             print("Loading unknown MIDI Hardware: "+name)
-        phat.add_instrument(Midi(hw._clients[name].client, name))
+        phat.add_instrument(Midi(client, name))
+
+class MidiDiscovery(object):
+    """Background thread watching for midi hardware coming and going.
+    
+    Every ``interval`` seconds the ALSA sequencer client list in /proc is
+    read, which is cheap, and only when its client or port names have
+    changed are the clients enumerated again. Each client that appears or disappears is posted as
+    a _MIDI_EVENT for the main loop to ``apply``, adding or removing its
+    Midi instrument.
+    """
+    def __init__(self, load_unknown=True, interval=2.0, path=_ASOUND_CLIENTS):
+        self.load_unknown = load_unknown
+        self.interval = interval
+        self.path = path
+        self.snapshot = None
+        self.clients = dict()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.scans = 0
+    
+    def changed(self):
+        """Whether the client list may have changed since the last scan"""
+        try:
+            with open(self.path, 'rb') as f:
+                # only the client and port names, the pool counters change
+                # with every event played
+                snapshot = [line for line in f
+                            if line.lstrip().startswith((b'Client ', b'Port '))]
+        except (IOError, OSError):
+            # no /proc to watch, enumerate every time
+            return True
+        if snapshot == self.snapshot:
+            return False
+        self.snapshot = snapshot
+        return True
+    
+    def scan(self):
+        """Post a _MIDI_EVENT for every client added or removed"""
+        self.scans += 1
+        try:
+            clients = midi_clients(self.load_unknown)
+        except Exception as e:
+            print("Error: couldn't list MIDI Hardware: {}".format(e))
+            return
+        for name, client in self.clients.items():
+            if clients.get(name) != client:
+                self.post(name, client, False)
+        for name, client in clients.items():
+            if self.clients.get(name) != client:
+                if name not in _MIDI_SUPPORTED:
+                    print("Loading unknown MIDI Hardware: "+name)
+                self.post(name, client, True)
+        self.clients = clients
+    
+    def post(self, name, client, present):
+        try:
+            pygame.event.post(pygame.event.Event(_MIDI_EVENT, name=name,
+                                                 client=client, present=present))
+        except pygame.error:
+            pass
+    
+    def apply(self, phat, event):
+        """_MIDI_EVENT handler, add or remove the client's instrument"""
+        if event.present:
+            phat.add_instrument(Midi(event.client, event.name))
+        else:
+            phat.remove_instrument("MIDI:"+event.name)
+    
+    def run(self):
+        while not self.stopped.is_set():
+            if self.changed():
+                self.scan()
+            self.stopped.wait(self.interval)
+    
+    def start(self):
+        if not midi or self.thread:
+            return
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name='MidiDiscovery')
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+class SoundIndex(object):
+    """Index of the instrument folders under ``base_folder``, made in one
+    pass over each folder and kept in a manifest file.
+    
+    Every file is classified by the KINDS of instrument that play it. A
+    folder is only listed again when its modification time changes, so
+    starting up stays quick however many samples there are. Only the names
+    of the files are kept, which editing a file doesn't change, and a
+    folder whose instrument files are the same after listing it again,
+    such as after its SampleBank was written, counts as reused.
+    """
+    FILENAME = '.pipianoui.manifest'
+    VERSION = 2
+    KINDS = (('samples', ('*.wav', '*.ogg')),
+             ('songs', ('*.mp3',)))
+    
+    def __init__(self, base_folder):
+        self.base_folder = base_folder
+        self.path = os.path.join(base_folder, self.FILENAME)
+        self.folders = dict()
+        self.scanned = 0
+        self.reused = 0
+    
+    def entries(self, folder):
+        """(name, is_dir) for everything in ``folder``"""
+        if _scandir:
+            for entry in _scandir(folder):
+                yield entry.name, entry.is_dir()
+        else:
+            for name in os.listdir(folder):
+                yield name, os.path.isdir(os.path.join(folder, name))
+    
+    def kind(self, name):
+        for kind, filetypes in self.KINDS:
+            if any(fnmatch.fnmatchcase(name, f) for f in filetypes):
+                return kind
+    
+    def scan(self, name, mtime):
+        """Classify the files in one folder"""
+        folder = os.path.join(self.base_folder, name)
+        files = dict()
+        for filename, is_dir in self.entries(folder):
+            kind = self.kind(filename)
+            if kind and not is_dir:
+                files[filename] = kind
+        return dict(mtime=mtime, files=files)
+    
+    def load(self):
+        try:
+            with open(self.path) as f:
+                manifest = json.load(f)
+        except (IOError, OSError, ValueError):
+            return dict()
+        if manifest.get('version') != self.VERSION:
+            return dict()
+        return manifest.get('folders', dict())
+    
+    def save(self):
+        try:
+            with open(self.path, 'w') as f:
+                json.dump(dict(version=self.VERSION, folders=self.folders), f)
+        except (IOError, OSError) as e:
+            print("Error: couldn't save sound index: {} {}".format(self.path, e))
+    
+    def update(self):
+        """Bring the index up to date with the folders, returns self"""
+        old = self.load()
+        folders = dict()
+        for name, is_dir in self.entries(self.base_folder):
+            if not is_dir:
+                continue
+            mtime = os.stat(os.path.join(self.base_folder, name)).st_mtime
+            entry = old.get(name)
+            if entry and entry['mtime'] == mtime:
+                self.reused += 1
+            else:
+                scanned = self.scan(name, mtime)
+                if entry and entry['files'] == scanned['files']:
+                    self.reused += 1
+                else:
+                    self.scanned += 1
+                entry = scanned
+            folders[name] = entry
+        self.folders = folders
+        if folders != old:
+            self.save()
+        return self
+    
+    def files(self, name, kind):
+        """Sorted paths of the ``kind`` files in folder ``name``"""
+        folder = os.path.join(self.base_folder, name)
+        files = [os.path.join(folder, filename)
+                 for filename, file_kind in self.folders[name]['files'].items()
+                 if file_kind == kind]
+        files.sort(key=natural_sort_key)
+        return files
+    
+    def __str__(self):
+        count = sum(len(f['files']) for f in self.folders.values())
+        return 'sound index {} folders {} files, {} listed {} from {}'.format(
+            len(self.folders), count, self.scanned, self.reused, self.FILENAME)
+
+def sample_reducer(trim_db, mono=False, bits=None):
+    """A SampleReducer trimming below ``trim_db``, or None if not set"""
+    return SampleReducer(trim_db, mono, bits) if trim_db is not None else None
+
+def wav_instrument_factories(index, software=False, pitch_shift=False, trim_db=None,
+                             sample_bits=None):
+    """(name, factory) for the ``WavPlayer`` and ``Songs`` in each folder of
+    a SoundIndex, depending on what files are found.
+    
+    With ``trim_db`` each WavPlayer reduces its samples with a SampleReducer,
+    folding them to mono, and counting them at ``sample_bits``, only for the
+    ``software`` mixer.
+    """
+    reducer = lambda: sample_reducer(trim_db, software, sample_bits if software else None)
+    result = []
+    for name in sorted(index.folders):
+        d = os.path.join(index.base_folder, name)
+        samples = index.files(name, 'samples')
+        if samples:
+            result.append(('WavPlayer:' + name,
+                lambda d=d, samples=samples: WavPlayer(d, software=software, files=samples,
+                                                       pitch_shift=pitch_shift,
+                                                       reducer=reducer())))
+        songs = index.files(name, 'songs')
+        if songs:
+            result.append(('Songs:' + name, lambda d=d, songs=songs: Songs(d, files=songs)))
+    return result
+
+def scan_wav_instruments(base_folder, software=False, pitch_shift=False, trim_db=None,
+                         sample_bits=None):
+    """LazyInstruments for the ``WavPlayer`` and ``Songs`` in each sub
+    directory of ``base_folder``, from the SoundIndex.
+    """
+    index = SoundIndex(base_folder).update()
+    return [LazyInstrument(name, factory) for name, factory in
+            wav_instrument_factories(index, software, pitch_shift, trim_db, sample_bits)]
 
-def load_wav_instruments(phat, base_folder):
+def load_wav_instruments(phat, base_folder, software=False, pitch_shift=False, trim_db=None,
+                         sample_bits=None):
     """Load each sub directory of a given ``base_folder`` as a` ``WavPlayer``
     or ``Songs`` Instrument depending on what files are found, and add that
     Instrument to the supplied ``PiPianoUI``.
+    
+    The files are found by a SoundIndex rather than searching the folders.
     """
-    wavinstdirs = glob.glob(os.path.join(base_folder, '*'))
-    for d in wavinstdirs:
-        if os.path.isdir(d):
-            inst = WavPlayer(d)
-            if inst.files:
-                phat.add_instrument(inst)
-            inst = Songs(d)
-            if inst.files:
-                phat.add_instrument(inst)
+    index = SoundIndex(base_folder).update()
+    print(index)
+    for name, factory in wav_instrument_factories(index, software, pitch_shift, trim_db,
+                                                  sample_bits):
+        phat.add_instrument(factory())
 
 
 _QUIT_KEYS = [
@@ -778,63 +4021,248 @@ _KEYMAP = [
     pygame.locals.K_i,
 ] + _QUIT_KEYS
 
+_LATENCY_KEY = pygame.locals.K_t
+_RECORD_KEY = pygame.locals.K_r
+_PLAY_KEY = pygame.locals.K_p
+_LOOP_KEY = pygame.locals.K_k
+_METRONOME_KEY = pygame.locals.K_w
 
+def toggle_recording(phat, folder):
+    """Start recording, or stop and save the recording as a .mid file in
+    ``folder``.
+    """
+    recorder = phat.recorder
+    if recorder.recording:
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        path = os.path.join(folder, time.strftime('recording-%Y%m%d-%H%M%S.mid'))
+        recorder.stop(path)
+        phat.message('saving {} notes'.format(recorder.count))
+    elif recorder.start():
+        phat.message('recording, r to stop')
+    else:
+        phat.message("can't record now, needs python-midi")
 
-def main():
+def show_latency(phat, path=None):
+    """Show the latency measurements for the current instrument, print
+    them all, and save them to ``path`` if given.
+    """
+    if not PROBE.enabled:
+        phat.message('latency not measured, use --latency')
+        return
+    lines = PROBE.report()
+    print('\n'.join(lines))
+    if path:
+        PROBE.dump(path)
+    current = [l for l in PROBE.report(phat.instrument.name) if ' play ' in l]
+    phat.message(current[0].split(' play ', 1)[1] if current else 'no latency yet')
+
+def main(argv=None):
     """Example program to load the sample instruments and run the UI.
     
     Will work on a computer or RaspberryPi w/o a PianoHAT for testing using
     the keyboard.
     
+    ``--build-bank FOLDER`` compiles a sample folder into a SampleBank
+    and exits. ``--max-fps`` limits how often the display is updated.
+    ``--draw-first`` draws each key before calling the instrument.
+    ``--latency`` measures the time from each key event to the instrument,
+    the mixer and the display; the 't' key shows the measurements for the
+    current instrument, and ``--latency-dump FILE`` saves them on exit.
+    ``--voice-policy`` picks which voice is stolen when every mixer channel
+    is busy. ``--software-mixer`` plays the synth and samples through the
+    SoftwareMixer. ``--record-dir`` is where recordings are saved.
+    ``--log-rate`` limits the console messages printed each second, and
+    ``--quiet`` prints none. ``--fast-start`` builds each instrument when
+    it is first selected and does the rest of starting up in parallel.
+    ``--play FILE`` plays a MIDI file through the current instrument.
+    ``--bpm``, ``--loop-bars`` and ``--click`` set up the looper and its
+    metronome.
+    
     Keyboard mappings:
     
         * z-<comma> are mapped to the keys.
         * o/l are octave up and down
         * i is instrument
+        * r starts and stops recording
+        * p starts and stops playing the --play file
+        * k records a loop, plays it, and stops it
+        * w turns the metronome on and off
         * q/<esc> quit
     """
+    parser = argparse.ArgumentParser(description="PiPianoUi")
+    parser.add_argument('--build-bank', metavar='FOLDER', action='append',
+                        help="compile a sample folder into a sample bank and exit")
+    parser.add_argument('--max-fps', type=int, default=_MAX_FPS,
+                        help="maximum display updates per second")
+    parser.add_argument('--draw-first', action='store_true',
+                        help="draw keys before playing them instead of after")
+    parser.add_argument('--latency', action='store_true',
+                        help="measure key press to sound latency")
+    parser.add_argument('--latency-dump', metavar='FILE',
+                        help="write the latency measurements to FILE on exit")
+    parser.add_argument('--voice-policy', choices=VoiceAllocator.POLICIES, default='oldest',
+                        help="voice to steal when all channels are playing")
+    parser.add_argument('--software-mixer', action='store_true',
+                        help="mix the synth and samples in software")
+    parser.add_argument('--pitch-shift', action='store_true',
+                        help="play every note of the sample folders by pitch shifting the nearest sample")
+    parser.add_argument('--trim-db', type=float, metavar='DB',
+                        help="trim silence quieter than DB from the samples as they load, "
+                             "and fold identical stereo to mono in the software mixer")
+    parser.add_argument('--sample-bits', type=int, choices=(8, 16), default=16,
+                        help="bit depth the software mixer keeps the samples and waves at, "
+                             "the sound played stays at the mixer's 16 bits")
+    parser.add_argument('--record-dir',
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'recordings'),
+                        help="folder recordings are saved in")
+    parser.add_argument('--log-rate', type=int, default=20,
+                        help="most console messages printed a second")
+    parser.add_argument('--quiet', action='store_true',
+                        help="don't print console messages")
+    parser.add_argument('--fast-start', action='store_true',
+                        help="build instruments when first selected, start up in parallel")
+    parser.add_argument('--bpm', type=int, default=120,
+                        help="tempo of the looper and metronome")
+    parser.add_argument('--loop-bars', type=int, default=2,
+                        help="length of a loop in bars of 4 beats")
+    parser.add_argument('--click',
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                             'sounds', 'drums', 'rim.wav'),
+                        help="sample the metronome plays on each beat")
+    parser.add_argument('--play', metavar='FILE',
+                        help="MIDI file to play through the current instrument")
+    args = parser.parse_args(argv)
+    if args.build_bank:
+        for folder in args.build_bank:
+            build_sample_bank(folder)
+        return
     print("""Keyboard also works:
     
     * z-<comma> are mapped to the keys.
     * o/l are octave up and down
     * i is instrument
+    * t shows latency measurements (with --latency)
+    * r starts and stops recording
+    * p starts and stops playing the --play file
+    * k records a loop, plays it, and stops it
+    * w turns the metronome on and off
     * q/<esc> quit
     """)
     # NOTE: Some of this logic should be moved into PiPianoUI
     #       Specifically the main loop.
     #       But that makes some customizations to keyboard/mouse control
     #       very difficult.
-    p = PiPianoUI()
-    p.add_instrument(Synth8Bit())
-    load_wav_instruments(p, os.path.join(os.path.dirname(__file__), 'sounds'))
-    load_midi_sequencers(p)
+    PROBE.enabled = args.latency or bool(args.latency_dump)
+    CONSOLE.set_rate(args.log_rate)
+    CONSOLE.enabled = not args.quiet and args.log_rate > 0
+    ENGINE.voices.policy = args.voice_policy
+    ENGINE.sample_bits = args.sample_bits
+    startup = StartupProfiler()
+    sounds = os.path.join(os.path.dirname(__file__), 'sounds')
+    if args.fast_start:
+        scan = startup.background('scan', scan_wav_instruments, sounds, args.software_mixer,
+                                  args.pitch_shift, args.trim_db, args.sample_bits)
+    p = PiPianoUI(max_fps=args.max_fps, audio_first=not args.draw_first,
+                  startup=startup, fast_start=args.fast_start)
+    if args.fast_start:
+        p.add_instrument(LazyInstrument('8BitSynth',
+                                        lambda: Synth8Bit(software=args.software_mixer)))
+        for instrument in scan.result():
+            p.add_instrument(instrument)
+    else:
+        p.add_instrument(Synth8Bit(software=args.software_mixer))
+        load_wav_instruments(p, sounds, software=args.software_mixer,
+                             pitch_shift=args.pitch_shift, trim_db=args.trim_db,
+                             sample_bits=args.sample_bits)
+    startup.mark('instruments')
+    discovery = MidiDiscovery()
+    discovery.start()
+    startup.mark('midi')
+    print(startup.report())
     p.message("{} insturments. q/<esc> to quit.".format(len(p.instruments)))
+    player = MidiFilePlayer(p)
+    p.looper = looper = Looper(p, bpm=args.bpm, bars=args.loop_bars,
+                               click=args.click if os.path.isfile(args.click) else None)
+    if args.play and midi:
+        player.play(args.play)
     quit = False
     while not quit:
         event = pygame.event.wait()
+        timestamp = _clock() if PROBE.enabled else None
         if event.type == pygame.locals.QUIT:
             quit = True
+        elif event.type == _MESSAGE_EVENT:
+            p.message(event.message)
+            continue
+        elif event.type == _FRAME_EVENT:
+            p.frame()
+            continue
+        elif event.type == _INPUT_EVENT:
+            p.handle_inputs()
+            continue
+        elif event.type == _MIDI_EVENT:
+            discovery.apply(p, event)
+            continue
         elif event.type not in [pygame.locals.KEYDOWN, pygame.locals.KEYUP]:
             continue
         if event.key in _QUIT_KEYS:
             quit = True
+        elif event.key == _LATENCY_KEY:
+            if event.type == pygame.locals.KEYDOWN:
+                show_latency(p, args.latency_dump)
+        elif event.key == _RECORD_KEY:
+            if event.type == pygame.locals.KEYDOWN:
+                toggle_recording(p, args.record_dir)
+        elif event.key in (_LOOP_KEY, _METRONOME_KEY):
+            if event.type == pygame.locals.KEYDOWN:
+                if event.key == _LOOP_KEY:
+                    p.message(looper.toggle())
+                else:
+                    p.message(looper.toggle_metronome())
+        elif event.key == _PLAY_KEY:
+            if event.type != pygame.locals.KEYDOWN:
+                pass
+            elif not args.play or not midi:
+                p.message('nothing to play, needs --play and python-midi')
+            elif player.playing():
+                player.stop()
+            else:
+                player.play(args.play)
         else:
             ## Keyboard controls
             try:
                 channel = _KEYMAP.index(event.key)
             except ValueError:
                 channel = -1
+            pressed = event.type == pygame.locals.KEYDOWN
             if channel > 15:
                 quit = True
-            elif channel < 13:
-                p.handle_note(channel, event.type == pygame.locals.KEYDOWN)
+            elif 0 <= channel < 13:
+                p.inputs.post('note', channel, pressed, timestamp=timestamp)
             elif channel == 13:
-                p.handle_octave_down(channel, event.type == pygame.locals.KEYDOWN)
+                p.inputs.post('octave_down', channel, pressed, timestamp=timestamp)
             elif channel == 14:
-                p.handle_octave_up(channel, event.type == pygame.locals.KEYDOWN)
+                p.inputs.post('octave_up', channel, pressed, timestamp=timestamp)
             elif channel == 15:
-                p.handle_instrument(channel, event.type == pygame.locals.KEYDOWN)
-        pygame.display.update()
+                p.inputs.post('instrument', channel, pressed, timestamp=timestamp)
+            # already on the main thread, no need to wait for the wake up
+            p.handle_inputs()
+    if args.latency_dump:
+        PROBE.dump(args.latency_dump)
+    CONSOLE.stop()
+    print(ENGINE.voices)
+    print(p.inputs)
+    if ENGINE.software:
+        print(ENGINE.software)
+    if p.recorder.recording:
+        toggle_recording(p, args.record_dir)
+        p.recorder.thread.join()
+    player.stop()
+    looper.stop()
+    discovery.stop()
+    p.renderer.stop()
+    ENGINE.quit()
     pygame.quit()
     raise SystemExit(0)
 